@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+micro-benchmark of extracting window.__playinfo__ and window.__INITIAL_STATE__
+from video pages, slicing the json out of the html text vs. parsing the page with BeautifulSoup
+
+saved pages in benchmarks/fixtures/*.html are used, e.g. saved with
+    curl -A Mozilla/5.0 https://www.bilibili.com/video/BV1MW411w79n > benchmarks/fixtures/BV1MW411w79n.html
+next to trimmed_video_page.html, a trimmed page laid out as a video page is, with a 12 p video,
+its dash playinfo in all qualities and codecs, and related videos rendered into the html
+a synthetic page of a similar size is used if there are none
+"""
+
+import argparse
+import glob
+import json
+import os
+import sys
+import timeit
+
+from bs4 import BeautifulSoup
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bilibili_video_spider import BilibiliVideo, BilibiliVideoPage, extract_window_json
+
+fixtures_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+
+def make_synthetic_page(p_num=200):
+    playinfo = {"code": 0, "data": {"dash": {
+        "video": [{"id": 80, "baseUrl": f"https://upos-sz-mirrorcos.bilivideo.com/{i}.m4s?deadline=0",
+                   "backupUrl": [f"https://upos-sz-mirrorkodo.bilivideo.com/{i}.m4s"],
+                   "bandwidth": 1000000 + i, "codecid": 7, "width": 1920, "height": 1080}
+                  for i in range(30)],
+        "audio": [{"id": 30280, "baseUrl": f"https://upos-sz-mirrorcos.bilivideo.com/{i}a.m4s",
+                   "bandwidth": 300000 + i} for i in range(3)]}}}
+    initial_state = {"aid": 1, "videoData": {
+        "title": "synthetic video",
+        "pages": [{"page": i, "part": f"part {i}", "cid": 100000 + i} for i in range(1, p_num + 1)]}}
+
+    filler = "".join(f'<div class="item"><a href="/video/{i}">related video {i}</a><span>{i} views</span></div>'
+                     for i in range(3000))
+
+    return ("<!DOCTYPE html><html><head><title>synthetic video</title>"
+            + "".join(f"<script src=\"/js/{i}.js\"></script>" for i in range(20))
+            + f"<script>window.__playinfo__={json.dumps(playinfo)}</script>"
+            + f"<script>window.__INITIAL_STATE__={json.dumps(initial_state)};(function(){{}}());</script>"
+            + f'</head><body><h1 class="video-title" title="synthetic video">synthetic video</h1>{filler}</body></html>')
+
+
+def extract_with_soup(html_text):
+    soup = BeautifulSoup(html_text, "html.parser")
+
+    playinfo_dict = json.loads(BilibiliVideoPage._get_script_window_playinfo(soup))
+    window_initial_state_dict = BilibiliVideo._get_window_initial_state_dict(soup)
+
+    return playinfo_dict, window_initial_state_dict
+
+
+def extract_directly(html_text):
+    return extract_window_json(html_text, "__playinfo__"), extract_window_json(html_text, "__INITIAL_STATE__")
+
+
+def bench(name, html_text, number):
+    # checks that both ways extract the same json before timing them
+    if extract_directly(html_text) != extract_with_soup(html_text):
+        print(f"{name}: extracted json differs from BeautifulSoup's")
+
+    soup_time = timeit.timeit(lambda: extract_with_soup(html_text), number=number) / number
+    direct_time = timeit.timeit(lambda: extract_directly(html_text), number=number) / number
+
+    print(f"{name} ({len(html_text) / 1024:.0f} KB): "
+          f"BeautifulSoup {soup_time * 1000:.2f} ms, direct {direct_time * 1000:.2f} ms, "
+          f"{soup_time / direct_time:.0f}x faster")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="bench_extract.py - benchmarks extracting json from video pages")
+    parser.add_argument("pages", nargs="*", help="saved video pages (defaults to benchmarks/fixtures/*.html)")
+    parser.add_argument("--number", "-n", action="store", default=20, type=int,
+                        help="num of extractions timed per page")
+    args = parser.parse_args()
+
+    page_paths = args.pages or sorted(glob.glob(os.path.join(fixtures_dir, "*.html")))
+    if not page_paths:
+        bench("synthetic page", make_synthetic_page(), args.number)
+    for page_path in page_paths:
+        with open(page_path, encoding="utf-8") as f:
+            bench(os.path.basename(page_path), f.read(), args.number)
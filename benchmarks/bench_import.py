@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+benchmark of the startup latency of bilibili_video_spider,
+timing fresh interpreters importing the module against bare ones
+
+exits with 1 if the median import time exceeds --max-ms, so that it can guard startup latency in ci, e.g.
+    python benchmarks/bench_import.py --max-ms 300
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# modules that must not be imported on startup
+lazy_modules = ["matplotlib", "selenium", "bs4", "aiohttp"]
+
+
+def time_interpreter(code, number):
+    times = []
+    for _ in range(number):
+        start_time = time.perf_counter()
+        subprocess.run([sys.executable, "-c", code], cwd=repo_dir, check=True)
+        times.append(time.perf_counter() - start_time)
+
+    return statistics.median(times)
+
+
+def get_slowest_imports(top_num):
+    # parses the cumulative times of -X importtime, which are written to stderr
+    process = subprocess.run([sys.executable, "-X", "importtime", "-c", "import bilibili_video_spider"],
+                             cwd=repo_dir, check=True, stderr=subprocess.PIPE, text=True)
+
+    imports = []
+    for line in process.stderr.splitlines():
+        fields = line.split("|")
+        if len(fields) == 3 and fields[1].strip().isdigit():
+            imports.append((int(fields[1]), fields[2].rstrip()))
+
+    return sorted(imports, reverse=True)[:top_num]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="bench_import.py - benchmarks importing bilibili_video_spider")
+    parser.add_argument("--number", "-n", action="store", default=10, type=int,
+                        help="num of interpreters timed")
+    parser.add_argument("--max-ms", action="store", type=float,
+                        help="max median ms of importing the module on top of a bare interpreter")
+    parser.add_argument("--top", action="store", default=10, type=int,
+                        help="num of the slowest imports listed")
+    args = parser.parse_args()
+
+    bare_time = time_interpreter("pass", args.number)
+    import_time = time_interpreter("import bilibili_video_spider", args.number) - bare_time
+    print(f"bare interpreter {bare_time * 1000:.0f} ms, importing bilibili_video_spider {import_time * 1000:.0f} ms "
+          f"(median of {args.number})")
+
+    print("slowest imports (cumulative):")
+    for cumulative_us, module_name in get_slowest_imports(args.top):
+        print(f"{cumulative_us / 1000:8.1f} ms {module_name}")
+
+    # checks that the optional subsystems stay lazy
+    check_code = ("import sys, bilibili_video_spider; "
+                  f"print(' '.join(m for m in {lazy_modules!r} if m in sys.modules))")
+    eager_modules = subprocess.run([sys.executable, "-c", check_code], cwd=repo_dir, check=True,
+                                   stdout=subprocess.PIPE, text=True).stdout.split()
+
+    failed = False
+    if eager_modules:
+        print(f"imported on startup: {', '.join(eager_modules)}")
+        failed = True
+    if args.max_ms is not None and import_time * 1000 > args.max_ms:
+        print(f"importing takes longer than {args.max_ms:.0f} ms")
+        failed = True
+
+    sys.exit(1 if failed else 0)
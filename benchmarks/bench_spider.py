@@ -0,0 +1,320 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+end-to-end benchmark of the spider against a local mock bilibili server,
+reporting ps/s, MB/s, peak memory, peak threads and cpu time of each run, which runs in a process of its own
+
+the mock server serves video pages, the playurl, reply and nav apis,
+and synthetic m4s/flv payloads generated with ffmpeg, with configurable latency, bandwidth and range support
+saved pages in benchmarks/fixtures/BV*.html are served for their bv nums, e.g. with
+    python benchmarks/bench_spider.py --bv-num BV1MW411w79n
+other bv nums get synthetic pages
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import re
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bilibili_video_spider import Spider, bilibili_video_batch_spider, _get_peak_rss
+
+fixtures_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+
+def make_media(media_dir, seconds, video_bitrate, flv_segment_num):
+    # encodes test patterns, so that the payloads can really be muxed
+    def lavfi_inputs(duration):
+        return ["-f", "lavfi", "-i", f"testsrc2=size=1280x720:rate=25:duration={duration}",
+                "-f", "lavfi", "-i", f"sine=frequency=440:duration={duration}"]
+
+    fragmented = ["-f", "mp4", "-movflags", "frag_keyframe+empty_moov+default_base_moof"]
+    commands = {
+        "video.m4s": [*lavfi_inputs(seconds), "-map", "0:v", "-c:v", "mpeg4", "-b:v", f"{video_bitrate}k",
+                      *fragmented],
+        "audio.m4s": [*lavfi_inputs(seconds), "-map", "1:a", "-c:a", "aac", "-b:a", "128k", *fragmented],
+        "segment.flv": [*lavfi_inputs(seconds / flv_segment_num), "-c:v", "flv1", "-b:v", f"{video_bitrate}k",
+                        "-c:a", "aac", "-f", "flv"],
+    }
+
+    media_paths = {}
+    for media_name, command in commands.items():
+        media_path = os.path.join(media_dir, media_name)
+        subprocess.run(["ffmpeg", "-y", *command, media_path], check=True,
+                       stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        media_paths[media_name] = media_path
+
+    return media_paths
+
+
+def make_playinfo(base_url, cid, ext, flv_segment_num):
+    if ext == "m4s":
+        return {"code": 0, "data": {"dash": {
+            "video": [{"id": 80, "baseUrl": f"{base_url}/media/video.m4s?cid={cid}",
+                       "backupUrl": [f"{base_url}/media/video.m4s?cid={cid}&backup=1"],
+                       "bandwidth": 1000000, "codecid": 7, "width": 1280, "height": 720}],
+            "audio": [{"id": 30280, "baseUrl": f"{base_url}/media/audio.m4s?cid={cid}",
+                       "bandwidth": 128000}]}}}
+
+    return {"code": 0, "data": {"durl": [{"order": i + 1, "url": f"{base_url}/media/segment.flv?cid={cid}&order={i}"}
+                                         for i in range(flv_segment_num)]}}
+
+
+def make_video_page(base_url, bv_num, p_num, ext, flv_segment_num):
+    av_num = int(re.sub(r"\D", "", bv_num) or 0) + 1
+    initial_state = {"aid": av_num, "videoData": {
+        "title": f"bench {bv_num}",
+        "pages": [{"page": i, "part": f"part {i}", "cid": av_num * 1000 + i} for i in range(1, p_num + 1)]}}
+    playinfo = make_playinfo(base_url, av_num * 1000 + 1, ext, flv_segment_num)
+
+    # the ext of a video is told from its page, so that "m4s" appears only in m4s pages
+    return ("<!DOCTYPE html><html><head><title>bench</title>"
+            + f"<script>window.__playinfo__={json.dumps(playinfo)}</script>"
+            + f"<script>window.__INITIAL_STATE__={json.dumps(initial_state)};(function(){{}}());</script>"
+            + "</head><body></body></html>")
+
+
+class MockBilibiliHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    # set by serve()
+    config = None
+    media = None
+
+    def log_message(self, *args):
+        pass
+
+    def handle(self):
+        # the spider drops the connections it has read enough of, e.g. after probing the size of a stream
+        try:
+            super().handle()
+        except ConnectionError:
+            pass
+
+    def _send(self, code, body, content_type="application/json", headers=None):
+        time.sleep(self.config["latency"])
+
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+
+        # throttles each connection to the bandwidth
+        bandwidth = self.config["bandwidth"]
+        block_size = 64 * 1024
+        for i in range(0, len(body), block_size):
+            self.wfile.write(body[i:i + block_size])
+            if bandwidth:
+                time.sleep(min(block_size, len(body) - i) / bandwidth)
+
+    def _send_json(self, obj):
+        self._send(200, json.dumps(obj).encode())
+
+    def _send_media(self, media_name):
+        data = self.media[media_name]
+
+        range_header = self.headers.get("Range")
+        if not range_header or not self.config["range"]:
+            return self._send(200, data, "video/mp4")
+
+        start, end = re.match(r"bytes=(\d+)-(\d*)", range_header).groups()
+        start, end = int(start), min(int(end) if end else len(data) - 1, len(data) - 1)
+        self._send(206, data[start:end + 1], "video/mp4",
+                   {"Content-Range": f"bytes {start}-{end}/{len(data)}"})
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        base_url = f"http://{self.headers['Host']}"
+        ext, p_num, flv_segment_num = self.config["ext"], self.config["p_num"], self.config["flv_segment_num"]
+
+        if url.path.startswith("/video/"):
+            bv_num = url.path.split("/")[2]
+            fixture_path = os.path.join(fixtures_dir, f"{bv_num}.html")
+            if os.path.exists(fixture_path):
+                with open(fixture_path, "rb") as f:
+                    return self._send(200, f.read(), "text/html")
+            return self._send(200, make_video_page(base_url, bv_num, p_num, ext, flv_segment_num).encode(),
+                              "text/html")
+        if url.path == "/x/player/playurl":
+            return self._send_json(make_playinfo(base_url, query["cid"][0], ext, flv_segment_num))
+        if url.path == "/x/v2/reply":
+            page_num = int(query.get("pn", ["1"])[0])
+            comment_count = self.config["comment_count"]
+            reply_num = max(min(20, comment_count - (page_num - 1) * 20), 0)
+            replies = [{"rpid": page_num * 100 + i, "mid": i, "member": {"uname": f"user {i}"}, "ctime": 0,
+                        "like": i, "rcount": 0, "content": {"message": f"comment {i} on page {page_num}"}}
+                       for i in range(reply_num)]
+            return self._send_json({"code": 0, "data": {"page": {"count": comment_count, "size": 20},
+                                                        "replies": replies}})
+        if url.path == "/x/web-interface/nav":
+            return self._send_json({"code": 0, "data": {"isLogin": True}})
+        if url.path.startswith("/media/"):
+            return self._send_media(url.path[len("/media/"):])
+
+        self._send(404, b"{}")
+
+
+def serve(config, media_paths, conn):
+    MockBilibiliHandler.config = config
+    MockBilibiliHandler.media = {}
+    for media_name, media_path in media_paths.items():
+        with open(media_path, "rb") as f:
+            MockBilibiliHandler.media[media_name] = f.read()
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), MockBilibiliHandler)
+    server.daemon_threads = True
+    conn.send(server.server_port)
+    server.serve_forever()
+
+
+def bench_run_in_child(args, base_url, targets, work_dir):
+    # runs in a fresh interpreter, so that the peak memory of the run is not that of an earlier one
+    context = multiprocessing.get_context("spawn")
+    parent_conn, child_conn = context.Pipe()
+    process = context.Process(target=_send_bench_run, args=(child_conn, args, base_url, targets, work_dir))
+    process.start()
+    result = parent_conn.recv()
+    process.join()
+
+    return result
+
+
+def _send_bench_run(conn, args, base_url, targets, work_dir):
+    conn.send(bench_run(args, base_url, targets, work_dir))
+
+
+def bench_run(args, base_url, targets, work_dir):
+    cookie_file = os.path.join(work_dir, "cookies.json")
+    with open(cookie_file, "w") as f:
+        json.dump([{"name": "SESSDATA", "value": "bench"}], f)
+    root_dir = os.path.join(work_dir, "videos")
+    os.makedirs(root_dir)
+
+    spider = Spider(cache_dir=work_dir, cookie_file=cookie_file, connection_num=args.connections,
+                    resolver=args.resolver, mux=args.mux, max_workers=args.max_workers,
+                    mux_thread_num=args.mux_threads, request_rate=0,
+                    www_url=base_url, api_url=base_url)
+
+    # samples the num of threads, which the asyncio engine is to keep down
+    peak_thread_num = [threading.active_count()]
+    sampling_done = threading.Event()
+
+    def sample_threads():
+        while not sampling_done.wait(0.01):
+            peak_thread_num[0] = max(peak_thread_num[0], threading.active_count())
+
+    sampling_thread = threading.Thread(target=sample_threads, daemon=True)
+    sampling_thread.start()
+
+    start_time = time.perf_counter()
+    start_self, start_children = resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)
+    scheduler = bilibili_video_batch_spider(targets, root_dir, args.engine, spider, comments=args.comments)
+    end_self, end_children = resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)
+    elapsed = time.perf_counter() - start_time
+    sampling_done.set()
+    sampling_thread.join()
+
+    def cpu_time(start, end):
+        return end.ru_utime - start.ru_utime + end.ru_stime - start.ru_stime
+
+    return {"engine": args.engine, "mux": args.mux, "ext": args.ext,
+            "p_scratched": scheduler.p_num_scratched, "p_failed": scheduler.p_num_failed,
+            "seconds": elapsed, "ps_per_second": scheduler.p_num_scratched / elapsed,
+            "mb_per_second": spider.metrics.byte_num / 1024 / 1024 / elapsed,
+            "peak_rss_mb": _get_peak_rss(), "peak_threads": peak_thread_num[0],
+            "cpu_seconds": cpu_time(start_self, end_self),
+            "ffmpeg_cpu_seconds": cpu_time(start_children, end_children)}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="bench_spider.py - benchmarks the spider against a mock server")
+    parser.add_argument("--bv-num", action="append", default=[],
+                        help="bv num to scratch, can be given more than once (defaults to synthetic videos)")
+    parser.add_argument("--videos", action="store", default=4, type=int,
+                        help="num of synthetic videos to scratch")
+    parser.add_argument("--ps", action="store", default=4, type=int,
+                        help="num of ps of each synthetic video")
+    parser.add_argument("--ext", action="store", default="m4s", choices=["m4s", "flv"],
+                        help="media served for the videos")
+    parser.add_argument("--flv-segments", action="store", default=2, type=int,
+                        help="num of segments of each flv p")
+    parser.add_argument("--media-seconds", action="store", default=10, type=float,
+                        help="duration of each synthetic p")
+    parser.add_argument("--video-bitrate", action="store", default=4000, type=int,
+                        help="bitrate in kbps of the synthetic video, which sets the size of each p")
+    parser.add_argument("--latency", action="store", default=20, type=float,
+                        help="ms the server waits before each response")
+    parser.add_argument("--bandwidth", action="store", default=0, type=int,
+                        help="KB/s each connection is throttled to (0 for unlimited)")
+    parser.add_argument("--no-range", action="store_true",
+                        help="ignoring range requests, so that media is downloaded in a single stream")
+    parser.add_argument("--comment-count", action="store", default=200, type=int,
+                        help="num of comments of each video")
+
+    parser.add_argument("--engine", action="store", default="threads", choices=["threads", "asyncio"])
+    parser.add_argument("--mux", action="store", default="files", choices=["files", "pipe"])
+    parser.add_argument("--resolver", action="store", default="api", choices=["api", "page"])
+    parser.add_argument("--connections", "-c", action="store", default=4, type=int)
+    parser.add_argument("--max-workers", action="store", default=16, type=int)
+    parser.add_argument("--mux-threads", action="store", type=int)
+    parser.add_argument("--comments", action="store_true", help="crawling comments too")
+
+    parser.add_argument("--runs", "-n", action="store", default=3, type=int, help="num of runs")
+    parser.add_argument("--json", action="store_true", help="printing a json line per run")
+    args = parser.parse_args()
+
+    if not shutil.which("ffmpeg"):
+        parser.error("ffmpeg is needed for generating and muxing the media")
+
+    targets = [(bv_num, f"1,{args.ps}") for bv_num in args.bv_num] \
+        or [(f"BV{i + 1}bench", f"1,{args.ps}") for i in range(args.videos)]
+
+    media_dir = tempfile.mkdtemp()
+    try:
+        media_paths = make_media(media_dir, args.media_seconds, args.video_bitrate, args.flv_segments)
+
+        config = {"ext": args.ext, "p_num": args.ps, "flv_segment_num": args.flv_segments,
+                  "latency": args.latency / 1000, "bandwidth": args.bandwidth * 1024,
+                  "range": not args.no_range, "comment_count": args.comment_count}
+        parent_conn, child_conn = multiprocessing.Pipe()
+        # serves from another process, so that it is not counted in the cpu time of the spider
+        server_process = multiprocessing.Process(target=serve, args=(config, media_paths, child_conn), daemon=True)
+        server_process.start()
+        base_url = f"http://127.0.0.1:{parent_conn.recv()}"
+
+        results = []
+        for run in range(args.runs):
+            work_dir = tempfile.mkdtemp()
+            try:
+                results.append(bench_run_in_child(args, base_url, targets, work_dir))
+            finally:
+                shutil.rmtree(work_dir, ignore_errors=True)
+        server_process.terminate()
+    finally:
+        shutil.rmtree(media_dir, ignore_errors=True)
+
+    print()
+    for run, result in enumerate(results):
+        if args.json:
+            print(json.dumps(result))
+        else:
+            print(f"run {run + 1}: {result['p_scratched']} ps ({result['p_failed']} failed) "
+                  f"in {result['seconds']:.2f} s, {result['ps_per_second']:.2f} ps/s, "
+                  f"{result['mb_per_second']:.1f} MB/s, peak memory {result['peak_rss_mb']:.1f} MB, "
+                  f"peak threads {result['peak_threads']}, "
+                  f"cpu {result['cpu_seconds']:.2f} s (ffmpeg {result['ffmpeg_cpu_seconds']:.2f} s)")
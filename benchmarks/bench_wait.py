@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+benchmark of the cpu time the spider burns while waiting,
+blocking the download of flv segments on a stalled one and measuring the cpu time of the process meanwhile
+
+exits with 1 if the cpu time exceeds --max-cpu of the wall time waited, so that a busy wait is caught, e.g.
+    python benchmarks/bench_wait.py --wait 5 --max-cpu 0.05
+"""
+
+import argparse
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bilibili_video_spider import Spider, Journal, PageDownloader
+
+segment_size = 1024 * 1024
+
+
+class StalledSegmentHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    # set by serve()
+    release_event = None
+
+    def log_message(self, *args):
+        pass
+
+    def handle(self):
+        # the spider drops the connections it has read enough of, e.g. after probing the size of a segment
+        try:
+            super().handle()
+        except ConnectionError:
+            pass
+
+    def do_GET(self):
+        # ignores range requests, so that each segment is a single stream
+        self.send_response(200)
+        self.send_header("Content-Type", "video/x-flv")
+        self.send_header("Content-Length", str(segment_size))
+        self.end_headers()
+
+        # sends half of the stalled segment, and the rest once released
+        if self.path.startswith("/stalled/"):
+            self.wfile.write(b"\0" * (segment_size // 2))
+            self.wfile.flush()
+            self.release_event.wait()
+            self.wfile.write(b"\0" * (segment_size - segment_size // 2))
+        else:
+            self.wfile.write(b"\0" * segment_size)
+
+
+def serve(release_event, conn):
+    StalledSegmentHandler.release_event = release_event
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StalledSegmentHandler)
+    server.daemon_threads = True
+    conn.send(server.server_port)
+    server.serve_forever()
+
+
+def get_cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="bench_wait.py - benchmarks the cpu time spent waiting on downloads")
+    parser.add_argument("--wait", action="store", default=5, type=float,
+                        help="seconds the segment stalls for while the cpu time is measured")
+    parser.add_argument("--segments", action="store", default=4, type=int,
+                        help="num of flv segments of the p, the last of which stalls")
+    parser.add_argument("--max-cpu", action="store", default=0.05, type=float,
+                        help="max cpu time spent waiting, as a fraction of the wall time waited")
+    args = parser.parse_args()
+
+    release_event = multiprocessing.Event()
+    parent_conn, child_conn = multiprocessing.Pipe()
+    # serves from another process, so that it is not counted in the cpu time of the spider
+    server_process = multiprocessing.Process(target=serve, args=(release_event, child_conn), daemon=True)
+    server_process.start()
+    base_url = f"http://127.0.0.1:{parent_conn.recv()}"
+
+    work_dir = tempfile.mkdtemp()
+    try:
+        spider = Spider(cache_dir=work_dir, cookie_file=os.path.join(work_dir, "cookies.json"), request_rate=0)
+        video_urls = [(i, f"{base_url}/{'stalled' if i == args.segments - 1 else 'segment'}/{i}.flv")
+                      for i in range(args.segments)]
+        bilibili_video_page = SimpleNamespace(p_num=1, p_title="wait", video_urls=video_urls, headers={},
+                                              backup_urls={})
+
+        page_downloader = PageDownloader(spider, work_dir, Journal(work_dir))
+        page_downloader.bilibili_video_page = bilibili_video_page
+        page_downloader.part = "wait/p1"
+
+        download_thread = Thread(target=page_downloader._download_flv)
+        download_thread.start()
+
+        # lets the other segments finish, so that only the wait for the stalled one is measured
+        time.sleep(1)
+        start_time, start_cpu_time = time.perf_counter(), get_cpu_time()
+        time.sleep(args.wait)
+        elapsed, cpu_time = time.perf_counter() - start_time, get_cpu_time() - start_cpu_time
+        stalled = download_thread.is_alive()
+
+        release_event.set()
+        download_thread.join()
+    finally:
+        server_process.terminate()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    print(f"waited {elapsed:.2f} s on a stalled segment, cpu {cpu_time * 1000:.1f} ms "
+          f"({cpu_time / elapsed * 100:.2f}% of a core)")
+
+    failed = False
+    if not stalled:
+        print("the download finished before the wait was measured")
+        failed = True
+    if cpu_time > args.max_cpu * elapsed:
+        print(f"waiting takes more than {args.max_cpu * 100:.0f}% of a core")
+        failed = True
+
+    sys.exit(1 if failed else 0)
@@ -3,33 +3,57 @@
 
 import queue
 import threading
+import itertools
 import json
 import argparse
+import asyncio
 import os
 import time
 import base64
+import io
 import subprocess
 import math
 import re
+import sys
+import errno
+import shutil
+import tempfile
+import hashlib
+import struct
+import zlib
 from threading import Thread
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import contextmanager, asynccontextmanager
+from urllib.parse import urlparse, urlencode, parse_qs
+from xml.etree import ElementTree
 
 import requests
-import matplotlib.pyplot as plt
-import matplotlib.image as mpimg
-from bs4 import BeautifulSoup
-from selenium import webdriver
-from selenium.webdriver.chrome.options import Options
-from selenium.webdriver.common.by import By
-from selenium.webdriver.support.wait import WebDriverWait
-from selenium.webdriver.support import expected_conditions as ec
-from selenium.webdriver.common.desired_capabilities import DesiredCapabilities
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# matplotlib, selenium, bs4 and aiohttp are imported where they are needed,
+# since most runs neither log in, parse whole pages nor use the asyncio engine
 
 join = os.path.join
 basename = os.path.basename
 
+err_msg = "bilibili_video_spider.py: error: "
+
+default_headers = {'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) '
+                                 'Chrome/83.0.4103.61 Safari/537.36'}
+default_www_url = "https://www.bilibili.com"
+default_api_url = "https://api.bilibili.com"
+
+default_cache_dir = join(os.path.expanduser("~"), ".cache", "bilibili_video_spider")
+
+# codecids of dash video streams
+dash_codec_ids = {"avc": 7, "hevc": 12, "av1": 13}
+
 
 def config_driver():
-    global driver
+    from selenium import webdriver
+    from selenium.webdriver.chrome.options import Options
+    from selenium.webdriver.common.desired_capabilities import DesiredCapabilities
 
     # generates a headless chrome driver
     capability = DesiredCapabilities.CHROME
@@ -38,10 +62,15 @@ def config_driver():
     chrome_options = Options()
     chrome_options.add_argument('--headless')
 
-    driver = webdriver.Chrome(options=chrome_options, desired_capabilities=capability)
+    return webdriver.Chrome(options=chrome_options, desired_capabilities=capability)
+
 
+def get_qrcode(driver):
+    """returns the png of the qr code for logging in, or None if it cannot be got"""
+    from selenium.webdriver.common.by import By
+    from selenium.webdriver.support.wait import WebDriverWait
+    from selenium.webdriver.support import expected_conditions as ec
 
-def get_qrcode():
     try:
         wait = WebDriverWait(driver, 20)
         wait.until(ec.presence_of_element_located((By.CLASS_NAME, "qrcode-img")))
@@ -50,11 +79,11 @@ def get_qrcode():
     except:
         print(f"{err_msg}cannot log in when scratching flv videos. "
               "flv videos can also be scratched, but with lower quality")
-        return
+        return None
 
     # gets the html test of the log in page
     login_html_text = driver.page_source
-    login_soup = BeautifulSoup(login_html_text, "html.parser")
+    login_soup = _parse_html(login_html_text)
 
     try:
         # gets the qr code
@@ -63,56 +92,280 @@ def get_qrcode():
     except:
         print(f"{err_msg}cannot log in when scratching flv videos. "
               "flv videos can also be scratched, but with lower quality")
-        return
+        return None
 
-    # gets and saves the qr code for logging in
     print("getting qr code for logging in")
-    qrcode_img = base64.urlsafe_b64decode(qrcode_img_url + '=' * (4 - len(qrcode_img_url) % 4))
-    with open("qrcode.png", "wb") as f:
-        f.write(qrcode_img)
+    return base64.urlsafe_b64decode(qrcode_img_url + '=' * (4 - len(qrcode_img_url) % 4))
+
+
+def _paeth(a, b, c):
+    p = a + b - c
+    pa, pb, pc = abs(p - a), abs(p - b), abs(p - c)
+    if pa <= pb and pa <= pc:
+        return a
+    return b if pb <= pc else c
+
+
+def _decode_png(png):
+    """returns the rows of luminances (0 for black to 255 for white) of a non-interlaced png"""
+    if png[:8] != b"\x89PNG\r\n\x1a\n":
+        raise ValueError("not a png")
+
+    # reads the chunks
+    pos = 8
+    idat = b""
+    palette = None
+    while pos < len(png):
+        length, chunk_type = struct.unpack(">I4s", png[pos:pos + 8])
+        chunk = png[pos + 8:pos + 8 + length]
+        pos += length + 12
+
+        if chunk_type == b"IHDR":
+            width, height, bit_depth, color_type, _, _, interlace = struct.unpack(">IIBBBBB", chunk)
+        elif chunk_type == b"PLTE":
+            palette = [chunk[i:i + 3] for i in range(0, len(chunk), 3)]
+        elif chunk_type == b"IDAT":
+            idat += chunk
+        elif chunk_type == b"IEND":
+            break
+    if interlace or bit_depth == 16:
+        raise ValueError("interlaced and 16-bit pngs not supported")
+
+    # unfilters the scanlines
+    channel_num = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}[color_type]
+    bpp = max(channel_num * bit_depth // 8, 1)
+    stride = math.ceil(width * channel_num * bit_depth / 8)
+    data = zlib.decompress(idat)
+    rows = []
+    prev_row = bytearray(stride)
+    for y in range(height):
+        filter_type = data[y * (stride + 1)]
+        row = bytearray(data[y * (stride + 1) + 1:(y + 1) * (stride + 1)])
+        for i in range(stride):
+            a = row[i - bpp] if i >= bpp else 0
+            b = prev_row[i]
+            c = prev_row[i - bpp] if i >= bpp else 0
+            row[i] = (row[i] + [0, a, b, (a + b) // 2, _paeth(a, b, c)][filter_type]) & 0xff
+        rows.append(row)
+        prev_row = row
+
+    # converts the pixels to luminances, taking transparent pixels as white
+    luminance_rows = []
+    for row in rows:
+        if bit_depth < 8:
+            samples = [(row[i * bit_depth // 8] >> (8 - bit_depth - i * bit_depth % 8)) & ((1 << bit_depth) - 1)
+                       for i in range(width)]
+            if color_type == 0:
+                samples = [sample * 255 // ((1 << bit_depth) - 1) for sample in samples]
+        else:
+            samples = row
 
+        luminances = []
+        for x in range(width):
+            pixel = samples[x * channel_num:(x + 1) * channel_num]
+            if color_type == 3:
+                pixel = palette[pixel[0]]
+            luminance = sum(pixel[:3]) // 3 if color_type in (2, 3, 6) else pixel[0]
+            if color_type in (4, 6):
+                luminance = 255 - (255 - luminance) * pixel[-1] // 255
+            luminances.append(luminance)
+        luminance_rows.append(luminances)
+
+    return luminance_rows
+
+
+def _get_qrcode_modules(luminance_rows):
+    """returns the rows of modules (True for dark ones) of the qr code in the image"""
+    dark_rows = [[luminance < 128 for luminance in row] for row in luminance_rows]
+
+    # finds the code within the quiet zone
+    dark_ys = [y for y, row in enumerate(dark_rows) if any(row)]
+    dark_xs = [x for x in range(len(dark_rows[0])) if any(row[x] for row in dark_rows)]
+    top, left, right = dark_ys[0], dark_xs[0], dark_xs[-1]
+
+    # the top left finder pattern starts with a dark run of 7 modules
+    run = 0
+    while left + run <= right and dark_rows[top][left + run]:
+        run += 1
+    module_size = run / 7
+
+    # samples the center of each module
+    module_num = round((right - left + 1) / module_size)
+    return [[dark_rows[int(top + (j + 0.5) * module_size)][int(left + (i + 0.5) * module_size)]
+             for i in range(module_num)]
+            for j in range(module_num)]
+
+
+def print_qrcode(png, quiet_zone=2):
+    # draws two rows of modules per line with half blocks,
+    # light modules in the foreground so that the code reads on dark terminals
+    modules = _get_qrcode_modules(_decode_png(png))
+    size = len(modules) + quiet_zone * 2
+    light = [[True] * size for _ in range(quiet_zone)] \
+        + [[True] * quiet_zone + [not dark for dark in row] + [True] * quiet_zone for row in modules] \
+        + [[True] * size for _ in range(quiet_zone + 1)]
+
+    for y in range(0, size, 2):
+        print("".join(" ▄▀█"[top * 2 + bottom] for top, bottom in zip(light[y], light[y + 1])))
+
+
+def _has_display():
+    return sys.platform in ("win32", "darwin") or bool(os.environ.get("DISPLAY") or os.environ.get("WAYLAND_DISPLAY"))
+
+
+def _show_qrcode_window(qrcode_png, is_logged_in, stop_event):
+    import matplotlib.pyplot as plt
+    import matplotlib.image as mpimg
 
-def wait_for_logging_in():
-    # displays the qr code
-    print("scan the qr code to log in for flv videos of higher qualities")
     print("close the qr code window to retrieve flv videos of lower qualities without logging in")
-    qrcode_img = mpimg.imread("qrcode.png")
+    qrcode_img = mpimg.imread(io.BytesIO(qrcode_png), format="png")
 
-    # waits for logging in
     def close():
-        start = time.time()
-        while re.compile(r"注册").search(driver.page_source) \
-                and time.time() - start <= 60:
-            pass
+        is_logged_in()
         plt.close('all')
 
-    Thread(target=close).start()
+    close_thread = Thread(target=close)
+    close_thread.start()
 
     plt.imshow(qrcode_img)
     plt.axis(False)
     while plt.get_fignums():
         plt.pause(5)
 
-    # removes the qr code
-    os.remove("qrcode.png")
+    # stops waiting when the window is closed, before the driver is quit
+    stop_event.set()
+    close_thread.join()
+
 
+def wait_for_logging_in(driver, qrcode_png, qr_mode="auto"):
+    from selenium.webdriver.support.wait import WebDriverWait
+    from selenium.common.exceptions import WebDriverException
 
-def log_in():
+    # waits for logging in, which sets the session cookie and leaves the log in page, or for being stopped
+    stop_event = threading.Event()
+
+    def is_logged_in():
+        try:
+            WebDriverWait(driver, 60, poll_frequency=1).until(
+                lambda d: stop_event.is_set() or d.get_cookie("SESSDATA")
+                or "passport.bilibili.com/login" not in d.current_url)
+        except WebDriverException:
+            # timed out, or the browser is gone
+            pass
+
+    # displays the qr code
+    print("scan the qr code to log in for flv videos of higher qualities")
+    if qr_mode == "window" or (qr_mode == "auto" and _has_display()):
+        try:
+            _show_qrcode_window(qrcode_png, is_logged_in, stop_event)
+            return
+        except ImportError:
+            # draws the qr code in the terminal if matplotlib is not installed, unless a window is asked for
+            if qr_mode == "window":
+                raise
+            print("matplotlib not installed, drawing the qr code in the terminal")
+
+    try:
+        print_qrcode(qrcode_png)
+    except Exception as e:
+        # leaves the qr code to an image viewer if it cannot be drawn
+        with open("qrcode.png", "wb") as f:
+            f.write(qrcode_png)
+        print(f"{err_msg}cannot draw the qr code ({e}), open qrcode.png to scan it")
+    print("waiting 60 s for the qr code to be scanned")
+    is_logged_in()
+
+
+def log_in(spider):
     # accesses the log in page
     login_page_url = "https://passport.bilibili.com/login"  # log in page
 
-    global driver
-    config_driver()
-    driver.get(login_page_url)
+    driver = config_driver()
+    try:
+        driver.get(login_page_url)
 
-    # gets the qr code for logging in
-    get_qrcode()
+        # gets the qr code for logging in, and waits for the user's scanning
+        qrcode_png = get_qrcode(driver)
+        if qrcode_png:
+            wait_for_logging_in(driver, qrcode_png, spider.qr_mode)
 
-    # waits for the user's scanning
-    wait_for_logging_in()
+        # hands the session over to the http client, so that the browser is not needed any more
+        cookies = driver.get_cookies()
+    finally:
+        driver.quit()
 
+    _set_cookies(spider, cookies)
+    if _is_logged_in(spider):
+        _save_cookies(spider, cookies)
 
-def validate_p_num(p_num, total_p_num):
+
+def _set_cookies(spider, cookies):
+    for cookie in cookies:
+        spider.http_client.session.cookies.set(cookie["name"], cookie["value"],
+                                               domain=cookie.get("domain", ".bilibili.com"),
+                                               path=cookie.get("path", "/"))
+
+
+def _is_logged_in(spider):
+    try:
+        r = spider.http_client.get(f"{spider.api_url}/x/web-interface/nav", headers=spider.headers)
+        r.raise_for_status()
+
+        return bool(r.json()["data"]["isLogin"])
+    except:
+        return False
+
+
+def _save_cookies(spider, cookies):
+    try:
+        os.makedirs(os.path.dirname(os.path.abspath(spider.cookie_file)), exist_ok=True)
+
+        # keeps the session cookies private to the user
+        with open(os.open(spider.cookie_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w") as f:
+            json.dump(cookies, f)
+    except OSError:
+        print(f"{err_msg}cannot save cookies to {spider.cookie_file}")
+
+
+def load_cookies(spider):
+    # reuses the cookies of a previous log in if they are still valid
+    try:
+        with open(spider.cookie_file) as f:
+            cookies = json.load(f)
+    except (OSError, ValueError):
+        return False
+
+    _set_cookies(spider, cookies)
+    if _is_logged_in(spider):
+        print(f"logged in with cookies from {spider.cookie_file}")
+        return True
+
+    print(f"cookies in {spider.cookie_file} expired")
+    spider.http_client.session.cookies.clear()
+    return False
+
+
+def log_in_for_flv(spider):
+    # logs in once per spider, or again once logged out if it rechecks the log in,
+    # starting a browser only if there are no valid cookies from a previous log in
+    with spider.login_lock:
+        if spider.login_tried:
+            if not spider.recheck_login or _is_logged_in(spider):
+                return
+            print("logged out, logging in again")
+            spider.http_client.session.cookies.clear()
+        spider.login_tried = True
+
+        if not load_cookies(spider):
+            # logging in is optional, since flv videos of lower qualities can be scratched without it
+            try:
+                log_in(spider)
+            except Exception as e:
+                print(f"{err_msg}cannot log in ({e}), scratching flv videos of lower qualities")
+
+
+def parse_p_num(p_num):
+    """parses 'P_NUM' or 'FROM_P_NUM,TO_P_NUM', raising ValueError if it is not a valid range"""
     p_nums = p_num.split(',')
 
     from_p_num = 1
@@ -124,20 +377,24 @@ def validate_p_num(p_num, total_p_num):
         from_p_num = p_nums[0]
         to_p_num = p_nums[1]
     else:
-        print(f"{err_msg}input: 'FROM_P_NUM, TO_P_NUM'")
-        exit(5)
+        raise ValueError("input: 'FROM_P_NUM, TO_P_NUM'")
 
     try:
         from_p_num = int(from_p_num)
         to_p_num = int(to_p_num)
-    except:
-        print(f"{err_msg}p nums should be ints")
-        exit(6)
+    except ValueError:
+        raise ValueError("p nums should be ints")
 
     # checks if from_p_num < to_p_num
     if not from_p_num <= to_p_num:
-        print(f"{err_msg}FROM-P-NUM greater than to_p_num")
-        exit(2)
+        raise ValueError("FROM_P_NUM greater than TO_P_NUM")
+
+    return from_p_num, to_p_num
+
+
+def validate_p_num(p_num, total_p_num):
+    from_p_num, to_p_num = parse_p_num(p_num)
+
     # checks if from_p_num is greater than 0
     if from_p_num <= 0:
         from_p_num = 1
@@ -148,6 +405,31 @@ def validate_p_num(p_num, total_p_num):
     return from_p_num, to_p_num
 
 
+_json_decoder = json.JSONDecoder()
+
+
+def extract_window_json(html_text, var_name):
+    # decodes the json assigned to window.<var_name> in place,
+    # without parsing the whole page
+    assignment = re.search(rf"window\.{re.escape(var_name)}\s*=\s*", html_text)
+    if not assignment:
+        return None
+
+    try:
+        window_json, _ = _json_decoder.raw_decode(html_text, assignment.end())
+    except ValueError:
+        return None
+
+    return window_json if isinstance(window_json, dict) else None
+
+
+def _parse_html(html_text):
+    # bs4 is only imported for the pages whose json cannot be sliced out of the html text
+    from bs4 import BeautifulSoup
+
+    return BeautifulSoup(html_text, "html.parser")
+
+
 def _make_dir(dir_path):
     print(f"creating dir {dir_path} for storing videos")
 
@@ -157,23 +439,832 @@ def _make_dir(dir_path):
         print(f"{dir_path} already exists")
 
 
+class TokenBucket:
+    """a thread safe token bucket refilled at rate tokens per second"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity else max(rate, 1)
+
+        self.tokens = self.capacity
+        self.last_refilled = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _take(self, tokens):
+        # takes the tokens, returning 0, or returns the time to wait for them
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last_refilled) * self.rate)
+            self.last_refilled = now
+
+            # lets a request larger than the capacity through once the bucket is full
+            if self.tokens >= min(tokens, self.capacity):
+                self.tokens -= tokens
+                return 0
+
+            return (min(tokens, self.capacity) - self.tokens) / self.rate
+
+    def acquire(self, tokens=1):
+        wait_time = self._take(tokens)
+        while wait_time:
+            time.sleep(wait_time)
+            wait_time = self._take(tokens)
+
+    async def acquire_async(self, tokens=1):
+        wait_time = self._take(tokens)
+        while wait_time:
+            await asyncio.sleep(wait_time)
+            wait_time = self._take(tokens)
+
+
+class HttpClient:
+    """a keep-alive session with pooled connections shared by all fetches"""
+
+    retry_status_codes = (500, 502, 503, 504)
+
+    def __init__(self, pool_size, per_host_limit, retry_num=3, backoff_factor=0.5, timeout=60,
+                 request_rate=0, on_throttled=None):
+        self.timeout = timeout
+        self.per_host_limit = per_host_limit
+        self.retry_num = retry_num
+        self.backoff_factor = backoff_factor
+
+        # paces api and page requests, which bilibili's anti-crawler watches, but not media streams
+        self.request_bucket = TokenBucket(request_rate) if request_rate > 0 else None
+        self.on_throttled = on_throttled
+
+        # retries on connection errors, timeouts and 5xx with an exponential backoff
+        retry = Retry(total=retry_num, backoff_factor=backoff_factor,
+                      status_forcelist=HttpClient.retry_status_codes, allowed_methods=frozenset(["GET", "HEAD"]),
+                      raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self.host_semaphores = {}
+        self.host_semaphores_lock = threading.Lock()
+
+    def _get_host_semaphore(self, url):
+        host = urlparse(url).netloc
+        with self.host_semaphores_lock:
+            if host not in self.host_semaphores:
+                self.host_semaphores[host] = threading.BoundedSemaphore(self.per_host_limit)
+
+            return self.host_semaphores[host]
+
+    def _check_throttled(self, status_code):
+        # 412 and 429 are how bilibili tells crawlers to slow down
+        if status_code in (412, 429) and self.on_throttled:
+            self.on_throttled()
+
+    def get(self, url, **kwargs):
+        if self.request_bucket:
+            self.request_bucket.acquire()
+
+        kwargs.setdefault("timeout", self.timeout)
+        with self._get_host_semaphore(url):
+            r = self.session.get(url, **kwargs)
+        self._check_throttled(r.status_code)
+
+        return r
+
+    @contextmanager
+    def stream(self, url, **kwargs):
+        # holds the host slot until the whole body is consumed
+        kwargs.setdefault("timeout", self.timeout)
+        with self._get_host_semaphore(url):
+            with self.session.get(url, stream=True, **kwargs) as r:
+                self._check_throttled(r.status_code)
+                yield r
+
+    def create_async_session(self):
+        """returns an aiohttp session for streaming media on the running event loop,
+        with the per host limit of the client, for which the connector waits without a thread"""
+        import aiohttp
+
+        return aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0, limit_per_host=self.per_host_limit),
+                                     timeout=aiohttp.ClientTimeout(sock_connect=self.timeout,
+                                                                   sock_read=self.timeout))
+
+    @asynccontextmanager
+    async def stream_async(self, session, url, **kwargs):
+        import aiohttp
+
+        # retries as the Retry of the requests session does, which aiohttp has no counterpart of
+        for i in range(self.retry_num + 1):
+            try:
+                r = await session.get(url, **kwargs)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                if i == self.retry_num:
+                    raise
+            else:
+                if r.status not in HttpClient.retry_status_codes or i == self.retry_num:
+                    break
+                r.release()
+            await asyncio.sleep(self.backoff_factor * 2 ** i)
+
+        self._check_throttled(r.status)
+        try:
+            yield r
+        finally:
+            r.release()
+
+
+class ConcurrencyController:
+    """grows and shrinks the num of concurrent downloads with the measured throughput, errors and throttling"""
+
+    def __init__(self, initial_limit, max_limit, interval=5, throttled_cooldown=30):
+        self.max_limit = max_limit
+        self.limit = max(1, min(initial_limit, max_limit))
+        self.active = 0
+        self.condition = threading.Condition()
+        # (loop, future) of the coroutines waiting for a slot, which cannot wait on the condition
+        self.async_waiters = []
+
+        self.interval = interval
+        self.throttled_cooldown = throttled_cooldown
+        self.throttled_until = 0
+
+        self.window_start = time.monotonic()
+        self.window_bytes = 0
+        self.window_error_num = 0
+        self.last_throughput = 0
+
+    def acquire(self):
+        with self.condition:
+            while self.active >= self.limit:
+                self.condition.wait()
+            self.active += 1
+
+    async def acquire_async(self):
+        # waits on a future woken whenever a slot may have become free,
+        # since a blocking wait on the condition would hold a thread of the loop
+        loop = asyncio.get_running_loop()
+        while True:
+            with self.condition:
+                if self.active < self.limit:
+                    self.active += 1
+                    return
+                waiter = loop.create_future()
+                self.async_waiters.append((loop, waiter))
+            try:
+                await waiter
+            finally:
+                with self.condition:
+                    if (loop, waiter) in self.async_waiters:
+                        self.async_waiters.remove((loop, waiter))
+
+    def _wake_async_waiters(self):
+        # wakes all of them to check for a slot again, so that none is left waiting on a wake up
+        # taken by a thread or a cancelled coroutine
+        for loop, waiter in self.async_waiters:
+            loop.call_soon_threadsafe(lambda waiter=waiter: waiter.done() or waiter.set_result(None))
+        self.async_waiters.clear()
+
+    def release(self):
+        with self.condition:
+            self.active -= 1
+            self.condition.notify()
+            self._wake_async_waiters()
+
+    def _set_limit(self, limit, reason):
+        limit = max(1, min(limit, self.max_limit))
+        if limit != self.limit:
+            print(f"{reason}, {'raising' if limit > self.limit else 'lowering'} concurrent downloads "
+                  f"from {self.limit} to {limit}")
+            self.limit = limit
+            self.condition.notify_all()
+            self._wake_async_waiters()
+
+    def _reset_window(self, now):
+        self.window_start = now
+        self.window_bytes = 0
+        self.window_error_num = 0
+
+    def _adjust(self):
+        now = time.monotonic()
+        elapsed = now - self.window_start
+        if elapsed < self.interval:
+            return
+
+        throughput = self.window_bytes / elapsed
+        if self.window_error_num:
+            self._set_limit(self.limit - 1, f"{self.window_error_num} download error(s)")
+        elif throughput < self.last_throughput * 0.8:
+            self._set_limit(self.limit - 1, "throughput dropped")
+        elif now >= self.throttled_until and self.active >= self.limit \
+                and throughput > self.last_throughput * 1.05:
+            # adds a download only while all slots are busy and the last one paid off
+            self._set_limit(self.limit + 1, "throughput grew")
+
+        self.last_throughput = throughput
+        self._reset_window(now)
+
+    def record_bytes(self, byte_num):
+        with self.condition:
+            self.window_bytes += byte_num
+            self._adjust()
+
+    def record_error(self):
+        with self.condition:
+            self.window_error_num += 1
+            self._adjust()
+
+    def record_throttled(self):
+        # backs off multiplicatively and holds off growing for a while
+        with self.condition:
+            now = time.monotonic()
+            if now < self.throttled_until - self.throttled_cooldown + self.interval:
+                return
+            self.throttled_until = now + self.throttled_cooldown
+
+            self._set_limit(self.limit // 2, "throttled by bilibili")
+            self.last_throughput = 0
+            self._reset_window(now)
+
+
+class Metrics:
+    """counts the bytes, times the stages and samples the queue depths of a run,
+    drawing progress bars and writing metrics files from a reporter thread"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+
+        self.start_time = time.monotonic()
+        self.byte_num = 0
+        # stage -> durations in seconds
+        self.stage_durations = {}
+        # part -> [bytes downloaded, total bytes (0 if unknown)]
+        self.parts = {}
+        # name -> func returning the current value
+        self.gauges = {}
+        # stage -> num of workers serving it
+        self.stage_worker_nums = {}
+
+        self.last_time = self.start_time
+        self.last_byte_num = 0
+
+        self.reporter_thread = None
+        self.stop_event = threading.Event()
+
+    @contextmanager
+    def time_stage(self, stage):
+        start_time = time.monotonic()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.stage_durations.setdefault(stage, []).append(time.monotonic() - start_time)
+
+    def set_gauge(self, name, func):
+        self.gauges[name] = func
+
+    def set_stage_worker_num(self, stage, worker_num):
+        self.stage_worker_nums[stage] = worker_num
+
+    def start_part(self, part):
+        with self.lock:
+            self.parts[part] = [0, 0]
+
+    def add_part_total(self, part, byte_num):
+        with self.lock:
+            if part in self.parts:
+                self.parts[part][1] += byte_num
+
+    def add_part_bytes(self, part, byte_num):
+        with self.lock:
+            self.byte_num += byte_num
+            if part in self.parts:
+                self.parts[part][0] += byte_num
+
+    def finish_part(self, part):
+        with self.lock:
+            self.parts.pop(part, None)
+
+    def snapshot(self):
+        now = time.monotonic()
+        with self.lock:
+            bytes_per_second = (self.byte_num - self.last_byte_num) / max(now - self.last_time, 1e-6)
+            self.last_time, self.last_byte_num = now, self.byte_num
+
+            stages = {stage: {"count": len(durations), "sum": sum(durations)}
+                      for stage, durations in self.stage_durations.items()}
+            byte_num = self.byte_num
+
+        gauges = {}
+        for name, func in self.gauges.items():
+            try:
+                gauges[name] = func()
+            except:
+                pass
+
+        return {"time": time.time(), "elapsed": now - self.start_time, "bytes": byte_num,
+                "bytes_per_second": bytes_per_second, "gauges": gauges, "stages": stages}
+
+    @staticmethod
+    def to_prometheus(snapshot):
+        lines = ["# TYPE bilibili_spider_bytes_downloaded_total counter",
+                 f"bilibili_spider_bytes_downloaded_total {snapshot['bytes']}",
+                 "# TYPE bilibili_spider_bytes_per_second gauge",
+                 f"bilibili_spider_bytes_per_second {snapshot['bytes_per_second']:.1f}"]
+        for name, value in snapshot["gauges"].items():
+            lines.append(f"# TYPE bilibili_spider_{name} gauge")
+            lines.append(f"bilibili_spider_{name} {value}")
+        lines.append("# TYPE bilibili_spider_stage_seconds summary")
+        for stage, stage_dict in snapshot["stages"].items():
+            lines.append(f'bilibili_spider_stage_seconds_sum{{stage="{stage}"}} {stage_dict["sum"]:.3f}')
+            lines.append(f'bilibili_spider_stage_seconds_count{{stage="{stage}"}} {stage_dict["count"]}')
+
+        return "\n".join(lines) + "\n"
+
+    def _write_metrics_file(self, metrics_file, snapshot):
+        if metrics_file.endswith(".prom"):
+            # replaces the file as a whole, so that a scraper never reads half of it
+            tmp_file_path = f"{metrics_file}.tmp"
+            with open(tmp_file_path, "w") as f:
+                f.write(self.to_prometheus(snapshot))
+            os.replace(tmp_file_path, metrics_file)
+        else:
+            with open(metrics_file, "a") as f:
+                f.write(json.dumps(snapshot) + "\n")
+
+    def _draw_progress(self, snapshot):
+        with self.lock:
+            parts = [(part, *byte_nums) for part, byte_nums in self.parts.items()]
+
+        bars = []
+        for part, byte_num, total_byte_num in parts:
+            if total_byte_num:
+                done = min(byte_num / total_byte_num, 1)
+                bars.append(f"{part} [{'#' * int(done * 10):-<10}] {done * 100:3.0f}%")
+            else:
+                bars.append(f"{part} {byte_num / 1024 / 1024:.1f} MB")
+        line = f"{snapshot['bytes_per_second'] / 1024 / 1024:.1f} MB/s | " + " | ".join(bars)
+
+        # redraws a single line cut to the width of the terminal
+        width = shutil.get_terminal_size().columns
+        sys.stdout.write(f"\r{line[:width - 1]}\033[K")
+        sys.stdout.flush()
+
+    def _report(self, progress, metrics_file, metrics_interval):
+        last_write_time = 0
+        while not self.stop_event.wait(1):
+            now = time.monotonic()
+            if not (progress or (metrics_file and now - last_write_time >= metrics_interval)):
+                continue
+
+            snapshot = self.snapshot()
+            if progress:
+                self._draw_progress(snapshot)
+            if metrics_file and now - last_write_time >= metrics_interval:
+                self._write_metrics_file(metrics_file, snapshot)
+                last_write_time = now
+
+    def start(self, progress=False, metrics_file=None, metrics_interval=5):
+        with self.lock:
+            self.start_time = self.last_time = time.monotonic()
+            self.byte_num = self.last_byte_num = 0
+            self.stage_durations = {}
+            self.parts = {}
+
+        self.progress = progress
+        self.metrics_file = metrics_file
+        if progress or metrics_file:
+            self.stop_event.clear()
+            self.reporter_thread = Thread(target=self._report, args=(progress, metrics_file, metrics_interval),
+                                          daemon=True)
+            self.reporter_thread.start()
+
+    def stop(self):
+        if self.reporter_thread:
+            self.stop_event.set()
+            self.reporter_thread.join()
+            self.reporter_thread = None
+
+            if self.progress:
+                sys.stdout.write("\r\033[K")
+            # writes the final numbers of the run, with the mean throughput over the whole run
+            if self.metrics_file:
+                with self.lock:
+                    self.last_time, self.last_byte_num = self.start_time, 0
+                self._write_metrics_file(self.metrics_file, self.snapshot())
+
+    def print_summary(self):
+        elapsed = time.monotonic() - self.start_time
+        print(f"downloaded {self.byte_num / 1024 / 1024:.1f} MB in {elapsed:.1f} s "
+              f"({self.byte_num / 1024 / 1024 / max(elapsed, 1e-6):.1f} MB/s)")
+
+        for stage, durations in self.stage_durations.items():
+            durations = sorted(durations)
+            p95 = durations[min(int(len(durations) * 0.95), len(durations) - 1)]
+            # busy time over the time all workers of the stage were there for
+            worker_num = self.stage_worker_nums.get(stage)
+            utilisation = f", {sum(durations) / (elapsed * worker_num) * 100:.0f}% of {worker_num} workers busy" \
+                if worker_num and elapsed > 0 else ""
+            print(f"{stage}: {len(durations)} in {sum(durations):.1f} s, "
+                  f"mean {sum(durations) / len(durations):.2f} s, p95 {p95:.2f} s, max {durations[-1]:.2f} s"
+                  + utilisation)
+
+
+class Spider:
+    """settings and resources shared by all videos scratched in a process"""
+
+    def __init__(self, cache_dir=default_cache_dir, meta_cache_ttl=0, cookie_file=None,
+                 chunk_size=1024 * 1024, connection_num=4, min_range_size=1024 * 1024,
+                 resolver="api", mux="files", get_url_thread_num=6, download_thread_num=6,
+                 per_host_connections=16, retry_num=3, comment_thread_num=4, comment_rate=5,
+                 danmaku_thread_num=2, max_workers=16, max_bandwidth=0, request_rate=10,
+                 max_height=0, codec=None, max_bitrate=0, min_speed=64 * 1024,
+                 progress=False, metrics_file=None, metrics_interval=5,
+                 www_url=default_www_url, api_url=default_api_url, media_store_dir=None, mux_thread_num=None,
+                 resolve_ahead=None, url_expiry_margin=300, qr_mode="auto"):
+        # base urls of the site and its api, which can point to a mirror or a mock server
+        self.www_url = www_url.rstrip("/")
+        self.api_url = api_url.rstrip("/")
+
+        self.cache_dir = cache_dir
+        self.meta_cache_ttl = meta_cache_ttl
+        self.cookie_file = cookie_file if cookie_file else join(cache_dir, "cookies.json")
+        # shows the qr code for logging in in a window, in the terminal, or in a window if there is a display
+        self.qr_mode = qr_mode
+
+        self.chunk_size = chunk_size
+        self.connection_num = connection_num
+        self.min_range_size = min_range_size
+
+        self.resolver = resolver
+        self.mux = mux
+
+        # picks the dash stream, 0 or None for no preference
+        self.max_height = max_height
+        self.codec = codec
+        self.max_bitrate = max_bitrate
+        # switches to a backup url when a download stays slower than min_speed bytes/s
+        self.min_speed = min_speed
+        if self.mux == "pipe" and not hasattr(os, "mkfifo"):
+            print(f"{err_msg}fifos not supported on this platform, muxing from tmp files")
+            self.mux = "files"
+
+        self.get_url_thread_num = get_url_thread_num
+        self.download_thread_num = download_thread_num
+        # runs an ffmpeg process per core
+        self.mux_thread_num = mux_thread_num if mux_thread_num else os.cpu_count() or 1
+
+        self.comment_thread_num = comment_thread_num
+        self.comment_rate = comment_rate
+        # shared by the comment crawls of all videos, so that comment_rate limits the whole run
+        self.comment_bucket = TokenBucket(comment_rate) if comment_rate > 0 else None
+        self.danmaku_thread_num = danmaku_thread_num
+
+        # starts with download_thread_num concurrent downloads, adapting up to max_workers
+        self.max_workers = max(max_workers, 1)
+        self.concurrency_controller = ConcurrencyController(download_thread_num, self.max_workers)
+
+        # resolves at most resolve_ahead ps ahead of the downloads, as many as can be downloaded at once by default,
+        # so that their urls are fresh and few ps sit in memory
+        self.resolve_ahead = resolve_ahead if resolve_ahead else self.max_workers
+        self.url_expiry_margin = url_expiry_margin
+        self.bandwidth_bucket = TokenBucket(max_bandwidth) if max_bandwidth > 0 else None
+
+        self.metrics = Metrics()
+
+        self.media_store = MediaStore(media_store_dir) if media_store_dir else None
+        self.progress = progress
+        self.metrics_file = metrics_file
+        self.metrics_interval = metrics_interval
+
+        # a piped p streams its video and audio at once, and a stream blocked on a full fifo keeps its host slot
+        # until ffmpeg reads the other one, so that every worker needs two slots of the cdn host not to deadlock
+        if self.mux == "pipe":
+            per_host_connections = max(per_host_connections, 2 * self.max_workers)
+
+        self.headers = dict(default_headers)
+        # sizes the connection pool to the num of requests that may be in flight at once
+        self.http_client = HttpClient(pool_size=get_url_thread_num + self.max_workers * max(connection_num, 2),
+                                      per_host_limit=per_host_connections, retry_num=retry_num,
+                                      request_rate=request_rate,
+                                      on_throttled=self.concurrency_controller.record_throttled)
+
+        self.login_tried = False
+        self.login_lock = threading.Lock()
+        # checks the log in again for each flv video, as the cookies may expire while the spider runs
+        self.recheck_login = False
+
+
+class Journal:
+    """progress of the parts and the partially downloaded files in a video dir,
+    which is also the manifest compared against when syncing"""
+
+    file_name = ".bilibili_video_spider.journal.json"
+
+    def __init__(self, dir_path, save_interval=1):
+        self.dir_path = dir_path
+        self.journal_path = join(dir_path, Journal.file_name)
+        self.save_interval = save_interval
+
+        self.lock = threading.Lock()
+        self.last_saved = 0
+
+        self.parts = {}
+        self.files = {}
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.journal_path, encoding="utf-8") as f:
+                journal_dict = json.load(f)
+
+            self.parts = journal_dict["parts"]
+            self.files = journal_dict["files"]
+        except (OSError, ValueError, KeyError):
+            pass
+
+    def _save(self, force=True):
+        # throttles frequent byte-range updates
+        if not force and time.time() - self.last_saved < self.save_interval:
+            return
+
+        tmp_journal_path = f"{self.journal_path}.tmp"
+        with open(tmp_journal_path, "w", encoding="utf-8") as f:
+            json.dump({"parts": self.parts, "files": self.files}, f, ensure_ascii=False)
+        os.replace(tmp_journal_path, self.journal_path)
+
+        self.last_saved = time.time()
+
+    def _get_part_output_path(self, part):
+        # outputs are journaled by name, so that the video dir can be moved or reached from another cwd,
+        # taking the name of the paths journaled before
+        output_name = part["output_name"] if "output_name" in part else basename(part["output_path"])
+
+        return join(self.dir_path, output_name)
+
+    def is_part_done(self, p_num):
+        return bool(self.get_output_path(p_num))
+
+    def get_part(self, p_num):
+        return self.parts.get(str(p_num))
+
+    def get_output_path(self, p_num):
+        """returns the output path of a finished part, or None if it is not finished or its output is gone"""
+        part = self.parts.get(str(p_num))
+        if not part:
+            return None
+
+        output_path = self._get_part_output_path(part)
+        return output_path if os.path.exists(output_path) else None
+
+    def find_part_by_cid(self, cid):
+        """returns the p num of a finished part with the cid whose output still exists"""
+        for p_num, part in self.parts.items():
+            if part.get("cid") == cid and os.path.exists(self._get_part_output_path(part)):
+                return int(p_num)
+
+        return None
+
+    def mark_part_done(self, p_num, output_path, cid=None):
+        with self.lock:
+            self.parts[str(p_num)] = {"output_name": basename(output_path), "cid": cid}
+            self._save()
+
+    def start_file(self, file_name, content_length):
+        """returns the byte ranges of the file still to be downloaded"""
+        with self.lock:
+            file = self.files.get(file_name)
+            if not file or file["content_length"] != content_length:
+                file = self.files[file_name] = {"content_length": content_length, "ranges": []}
+                self._save()
+
+            missing_ranges = []
+            start = 0
+            for done_start, done_end in sorted(file["ranges"]):
+                if done_start > start:
+                    missing_ranges.append((start, done_start - 1))
+                start = max(start, done_end + 1)
+            if start < content_length:
+                missing_ranges.append((start, content_length - 1))
+
+            return missing_ranges
+
+    def add_range(self, file_name, start, end):
+        with self.lock:
+            file = self.files[file_name]
+
+            # merges the range with the overlapping and adjacent ones
+            ranges = []
+            for done_start, done_end in sorted(file["ranges"] + [[start, end]]):
+                if ranges and done_start <= ranges[-1][1] + 1:
+                    ranges[-1][1] = max(ranges[-1][1], done_end)
+                else:
+                    ranges.append([done_start, done_end])
+            file["ranges"] = ranges
+
+            self._save(force=False)
+
+    def is_file_complete(self, file_name, content_length=None):
+        with self.lock:
+            file = self.files.get(file_name)
+
+            return bool(file) and file["ranges"] == [[0, file["content_length"] - 1]] \
+                and content_length in (None, file["content_length"])
+
+    def finish_file(self, file_name, content_length):
+        # keeps the file until it is muxed, so that a finished stream is not downloaded again
+        with self.lock:
+            self.files[file_name] = {"content_length": content_length, "ranges": [[0, content_length - 1]]}
+            self._save()
+
+    def remove_file(self, file_name):
+        with self.lock:
+            self.files.pop(file_name, None)
+            self._save()
+
+
+def _link_or_copy(src_path, dst_path):
+    # hardlinks, or reflinks where the filesystem can but a hardlink fails on it, e.g. at the max num of links,
+    # copying otherwise, e.g. across filesystems, which neither can link across
+    try:
+        os.link(src_path, dst_path)
+        return
+    except OSError:
+        pass
+
+    try:
+        import fcntl
+    except ImportError:
+        fcntl = None
+
+    if fcntl:
+        try:
+            with open(src_path, "rb") as src, open(dst_path, "wb") as dst:
+                # FICLONE
+                fcntl.ioctl(dst.fileno(), 0x40049409, src.fileno())
+            return
+        except OSError:
+            # removes the empty file created for the reflink
+            if os.path.exists(dst_path):
+                os.remove(dst_path)
+
+    shutil.copyfile(src_path, dst_path)
+
+
+class MediaStore:
+    """media shared by all video dirs, keyed by cid and quality,
+    so that a stream appearing in several videos is downloaded and stored once"""
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+
+        # keys being downloaded, which other downloads of the same key wait for
+        self.pending_keys = set()
+        self.condition = threading.Condition()
+
+    @staticmethod
+    def get_key(bilibili_video_page):
+        return f"{bilibili_video_page.cid}_{bilibili_video_page.quality}"
+
+    def _get_path(self, key, ext):
+        # fans out by cid, so that no dir grows too large
+        return join(self.store_dir, key.split("_")[0][-2:], f"{key}.{'mp4' if ext == 'm4s' else 'flv'}")
+
+    def acquire(self, key, ext):
+        """returns the stored path of the key, or None if the caller is to download it and add() it"""
+        with self.condition:
+            while key in self.pending_keys:
+                self.condition.wait()
+
+            stored_path = self._get_path(key, ext)
+            if os.path.exists(stored_path):
+                return stored_path
+
+            self.pending_keys.add(key)
+            return None
+
+    def release(self, key):
+        with self.condition:
+            self.pending_keys.discard(key)
+            self.condition.notify_all()
+
+    def add(self, key, ext, output_path):
+        stored_path = self._get_path(key, ext)
+        os.makedirs(os.path.dirname(stored_path), exist_ok=True)
+
+        # links under a tmp name first, so that the store never holds a half-copied file
+        tmp_stored_path = f"{stored_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        _link_or_copy(output_path, tmp_stored_path)
+        os.replace(tmp_stored_path, stored_path)
+
+
+class BilibiliVideoMeta:
+    """metadata of a video shared by all of its pages"""
+
+    def __init__(self, av_num, video_title, ext, p_title_list, cid_list, total_comment_page_num):
+        self.av_num = av_num
+        self.video_title = video_title
+        self.ext = ext
+        self.p_title_list = p_title_list
+        self.cid_list = cid_list
+        self.total_comment_page_num = total_comment_page_num
+
+    def to_dict(self):
+        return {
+            "av_num": self.av_num,
+            "video_title": self.video_title,
+            "ext": self.ext,
+            "p_title_list": self.p_title_list,
+            "cid_list": self.cid_list,
+            "total_comment_page_num": self.total_comment_page_num,
+        }
+
+    @classmethod
+    def from_dict(cls, meta_dict):
+        return cls(meta_dict["av_num"], meta_dict["video_title"], meta_dict["ext"],
+                   meta_dict["p_title_list"], meta_dict["cid_list"], meta_dict["total_comment_page_num"])
+
+
+def _meta_cache_path(spider, bv_num):
+    return join(spider.cache_dir, f"BV{bv_num}.json")
+
+
+def _load_cached_meta(spider, bv_num):
+    if spider.meta_cache_ttl <= 0:
+        return None
+
+    cache_path = _meta_cache_path(spider, bv_num)
+    try:
+        # ignores expired caches
+        if time.time() - os.path.getmtime(cache_path) > spider.meta_cache_ttl:
+            return None
+
+        with open(cache_path, encoding="utf-8") as f:
+            return BilibiliVideoMeta.from_dict(json.load(f))
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def _save_cached_meta(spider, bv_num, meta):
+    if spider.meta_cache_ttl <= 0:
+        return
+
+    try:
+        os.makedirs(spider.cache_dir, exist_ok=True)
+
+        # writes to a tmp file first so that a concurrent reader never sees a half-written cache
+        cache_path = _meta_cache_path(spider, bv_num)
+        tmp_cache_path = f"{cache_path}.{os.getpid()}.tmp"
+        with open(tmp_cache_path, "w", encoding="utf-8") as f:
+            json.dump(meta.to_dict(), f, ensure_ascii=False)
+        os.replace(tmp_cache_path, cache_path)
+    except OSError:
+        print(f"{err_msg}cannot cache metadata of BV{bv_num}")
+
+
 class BilibiliVideo:
-    def __init__(self, bv_num):
+    def __init__(self, bv_num, spider, meta=None, use_cache=True):
         self.bv_num = bv_num if bv_num[:2] != 'BV' else bv_num[2:]
-
-        self.url = f"https://www.bilibili.com/video/BV{self.bv_num}"
-        self.av_num, self.video_title, self.ext, self.p_title_list, self.cid_list = self._get_videos_info()
+        self.spider = spider
+
+        self.url = f"{spider.www_url}/video/BV{self.bv_num}"
+        self.headers = {**spider.headers, 'Referer': self.url}
+
+        # reuses the metadata if given, so that pages do not re-fetch the video page
+        self.meta = meta if meta else self._get_meta(use_cache)
+        self.av_num = self.meta.av_num
+        self.video_title = self.meta.video_title
+        self.ext = self.meta.ext
+        self.p_title_list = self.meta.p_title_list
+        self.cid_list = self.meta.cid_list
         self.total_p_num = len(self.p_title_list)
 
-        self.total_comment_page_num = self._get_comments_info()
-        self.comment_urls = [f"https://api.bilibili.com/x/v2/reply?pn={pn}&type=1&oid={self.av_num}&sort=2"
-                             for pn in range(1, self.total_comment_page_num + 1)]
+        self.total_comment_page_num = self.meta.total_comment_page_num
+
+    @property
+    def comment_urls(self):
+        return [f"{self.spider.api_url}/x/v2/reply?pn={pn}&type=1&oid={self.av_num}&sort=2"
+                for pn in range(1, self.total_comment_page_num + 1)]
+
+    def get_danmaku_url(self, p_num):
+        return f"{self.spider.api_url}/x/v1/dm/list.so?oid={self.cid_list[p_num - 1]}"
+
+    def _get_meta(self, use_cache=True):
+        meta = _load_cached_meta(self.spider, self.bv_num) if use_cache else None
+        if meta:
+            return meta
+
+        av_num, video_title, ext, p_title_list, cid_list = self._get_videos_info()
+        total_comment_page_num = self._get_comments_info(av_num)
 
-    def _get_comments_info(self):
+        meta = BilibiliVideoMeta(av_num, video_title, ext, p_title_list, cid_list, total_comment_page_num)
+        _save_cached_meta(self.spider, self.bv_num, meta)
+
+        return meta
+
+    def _get_comments_info(self, av_num):
         try:
-            comment_url = f"https://api.bilibili.com/x/v2/reply?pn=1&type=1&oid={self.av_num}&sort=2"
+            comment_url = f"{self.spider.api_url}/x/v2/reply?pn=1&type=1&oid={av_num}&sort=2"
 
-            r = requests.get(comment_url)
+            r = self.spider.http_client.get(comment_url, headers=self.headers)
             r.raise_for_status()
         except:
             print(f"{err_msg}cannot get total comment page num")
@@ -199,16 +1290,18 @@ class BilibiliVideo:
 
     def _get_videos_info(self):
         try:
-            r = requests.get(self.url, headers=headers, timeout=60)
+            r = self.spider.http_client.get(self.url, headers=self.headers)
             html_text = r.text
         except:
             print(f"{err_msg}cannot access to {self.url}")
-            exit(1)
+            raise
         else:
-            soup = BeautifulSoup(html_text, "html.parser")
-
-            # gets window_initial_state dict
-            window_initial_state_dict = BilibiliVideo._get_window_initial_state_dict(soup)
+            # gets window_initial_state dict,
+            # parsing the whole page only if it cannot be sliced out of the html text
+            window_initial_state_dict = extract_window_json(html_text, "__INITIAL_STATE__")
+            if not window_initial_state_dict:
+                soup = _parse_html(html_text)
+                window_initial_state_dict = BilibiliVideo._get_window_initial_state_dict(soup)
             # gets the pages dict
             pages = window_initial_state_dict["videoData"]["pages"]
 
@@ -216,7 +1309,10 @@ class BilibiliVideo:
             av_num = window_initial_state_dict["aid"]
 
             # gets the title of the videos
-            video_title = soup.find("h1", "video-title")["title"]
+            video_title = window_initial_state_dict["videoData"].get("title")
+            if not video_title:
+                soup = _parse_html(html_text)
+                video_title = soup.find("h1", "video-title")["title"]
 
             # gets the ext
             ext = "m4s" if "m4s" in html_text else "flv"
@@ -230,45 +1326,58 @@ class BilibiliVideo:
             return av_num, video_title, ext, p_title_list, cid_list
 
 
+def _get_url_deadline(url):
+    try:
+        return int(parse_qs(urlparse(url).query)["deadline"][0])
+    except (KeyError, ValueError):
+        return None
+
+
 class BilibiliVideoPage(BilibiliVideo):
     def __init__(self, bilibili_video, p_num):
-        super(BilibiliVideoPage, self).__init__(bilibili_video.bv_num)
+        super(BilibiliVideoPage, self).__init__(bilibili_video.bv_num, bilibili_video.spider,
+                                                meta=bilibili_video.meta)
 
         self.url = bilibili_video.url
         self.p_num = p_num
 
         self.p_url = f"{self.url}?p={self.p_num}"
         self.p_title = self.p_title_list[self.p_num - 1]
-        self.danmaku_url = f"https://api.bilibili.com/x/v1/dm/list.so?oid={self.cid_list[p_num - 1]}"
+        self.cid = self.cid_list[self.p_num - 1]
+        self.danmaku_url = self.get_danmaku_url(self.p_num)
+
+        self._resolve_urls()
 
+    def _resolve_urls(self):
+        # maps each download url to the backup urls of the same stream on other cdns
+        self.backup_urls = {}
         if self.ext == "m4s":
             self.audio_url, self.video_url = self._get_m4s_urls()
+            urls = [self.audio_url, self.video_url]
         else:
             self.video_urls = self._get_flv_urls()
+            urls = [url for _, url in self.video_urls]
 
-    def _get_html_text(self):
-        if not driver:
-            # for m4s videos and flv videos without logging in
-            try:
-                r = requests.get(self.p_url, headers=headers, timeout=60)
-                r.raise_for_status()
+        # the cdn urls stop working at the unix time in their deadline param
+        deadlines = [deadline for deadline in map(_get_url_deadline, urls) if deadline]
+        self.deadline = min(deadlines) if deadlines else None
 
-                return r.text
-            except:
-                print(f"{err_msg}cannot get html text of p{self.p_num}")
-        else:
-            # for flv videos with logging in
-            try:
-                driver_lock.acquire()
-                driver.get(self.p_url)
+    def is_stale(self, margin):
+        """returns whether the download urls expire within margin seconds"""
+        return self.deadline is not None and time.time() > self.deadline - margin
 
-                WebDriverWait(driver, 10).until(ec.presence_of_element_located((By.XPATH, "/html/head/script[3]")))
+    def refresh_urls(self):
+        print(f"download urls of p{self.p_num} expired, resolving them again")
+        self._resolve_urls()
 
-                return driver.page_source
-            except:
-                print(f"{err_msg}cannot get html text of p{self.p_num}")
-            finally:
-                driver_lock.release()
+    def _get_html_text(self):
+        try:
+            r = self.spider.http_client.get(self.p_url, headers=self.headers)
+            r.raise_for_status()
+
+            return r.text
+        except:
+            print(f"{err_msg}cannot get html text of p{self.p_num}")
 
     @classmethod
     def _get_script_window_playinfo(cls, soup):
@@ -284,7 +1393,11 @@ class BilibiliVideoPage(BilibiliVideo):
         return script_window_playinfo
 
     def _get_playinfo_dict(self, html_text):
-        soup = BeautifulSoup(html_text, "html.parser")
+        playinfo_dict = extract_window_json(html_text, "__playinfo__")
+        if playinfo_dict:
+            return playinfo_dict
+
+        soup = _parse_html(html_text)
         # retrieves the script tag containing needed download urls
         script_window_playinfo = BilibiliVideoPage._get_script_window_playinfo(soup)
 
@@ -296,255 +1409,1467 @@ class BilibiliVideoPage(BilibiliVideo):
         except:
             print(f"{err_msg}cannot get <script> with needed urls for p{self.p_num}")
 
+    def _get_api_playinfo_dict(self):
+        # asks the playurl api for the playinfo of the p directly, without loading its page,
+        # with all the dash streams (hdr, 4k, av1, ...) to choose from
+        fnval = 4048 if self.ext == "m4s" else 0
+        playurl = (f"{self.spider.api_url}/x/player/playurl"
+                   f"?bvid=BV{self.bv_num}&cid={self.cid}&qn=116&fnval={fnval}&fourk=1")
+        try:
+            r = self.spider.http_client.get(playurl, headers=self.headers)
+            r.raise_for_status()
+
+            playinfo_dict = r.json()
+            if playinfo_dict["code"] != 0:
+                raise ValueError(playinfo_dict.get("message"))
+
+            return playinfo_dict
+        except:
+            print(f"{err_msg}cannot get playinfo of p{self.p_num} from the playurl api, trying its page")
+
+    def _get_playinfo(self):
+        if self.spider.resolver == "api":
+            playinfo_dict = self._get_api_playinfo_dict()
+            if playinfo_dict:
+                return playinfo_dict
+
+        return self._get_playinfo_dict(self._get_html_text())
+
+    def _select_video_stream(self, video_streams):
+        # drops the streams over the limits, keeping the smallest one if none is within them
+        max_height, max_bitrate = self.spider.max_height, self.spider.max_bitrate
+        streams = [stream for stream in video_streams
+                   if (not max_height or stream.get("height", 0) <= max_height)
+                   and (not max_bitrate or stream.get("bandwidth", 0) <= max_bitrate)]
+        if not streams:
+            print(f"{err_msg}no stream of p{self.p_num} within the quality limits, taking the smallest one")
+            return min(video_streams, key=lambda stream: stream.get("bandwidth", 0))
+
+        # keeps the highest resolution left
+        height = max(stream.get("height", 0) for stream in streams)
+        streams = [stream for stream in streams if stream.get("height", 0) == height]
+
+        if self.spider.codec == "smallest":
+            return min(streams, key=lambda stream: stream.get("bandwidth", 0))
+
+        # prefers the codec if it is available in that resolution
+        if self.spider.codec:
+            streams = [stream for stream in streams
+                       if stream.get("codecid") == dash_codec_ids[self.spider.codec]] or streams
+
+        return max(streams, key=lambda stream: stream.get("bandwidth", 0))
+
+    def _add_backup_urls(self, url, backup_urls):
+        if backup_urls:
+            self.backup_urls[url] = [backup_url for backup_url in backup_urls if backup_url != url]
+
     def _get_m4s_urls(self):
-        playinfo_dict = self._get_playinfo_dict(self._get_html_text())
+        playinfo_dict = self._get_playinfo()
 
-        video_url = playinfo_dict["data"]["dash"]["video"][0]["baseUrl"]
-        audio_url = playinfo_dict["data"]["dash"]["audio"][0]["baseUrl"]
+        dash = playinfo_dict["data"]["dash"]
+        video_stream = self._select_video_stream(dash["video"])
+        audio_stream = max(dash["audio"], key=lambda stream: stream.get("bandwidth", 0))
+        self.quality = f"{video_stream.get('id')}-{video_stream.get('codecid')}-{audio_stream.get('id')}"
+
+        codec_names = {codec_id: codec_name for codec_name, codec_id in dash_codec_ids.items()}
+        print(f"p{self.p_num}: {video_stream.get('height', '?')}p "
+              f"{codec_names.get(video_stream.get('codecid'), video_stream.get('codecs', '?'))} "
+              f"{(video_stream.get('bandwidth', 0) + audio_stream.get('bandwidth', 0)) / 1000:.0f} kbps")
+
+        # the keys are spelt either way depending on whether they come from the api or the page
+        video_url = video_stream.get("baseUrl") or video_stream["base_url"]
+        audio_url = audio_stream.get("baseUrl") or audio_stream["base_url"]
+        self._add_backup_urls(video_url, video_stream.get("backupUrl") or video_stream.get("backup_url"))
+        self._add_backup_urls(audio_url, audio_stream.get("backupUrl") or audio_stream.get("backup_url"))
 
         return audio_url, video_url
 
     def _get_flv_urls(self):
-        playinfo_dict = self._get_playinfo_dict(self._get_html_text())
+        playinfo_dict = self._get_playinfo()
+
+        self.quality = f"flv{playinfo_dict['data'].get('quality')}"
 
         video_urls = []
         for durl in playinfo_dict["data"]["durl"]:
             video_urls.append((durl["order"], durl["url"]))
+            self._add_backup_urls(durl["url"], durl.get("backup_url"))
         video_urls = sorted(video_urls, key=lambda elem: elem[0])
 
         return video_urls
 
 
+def _run_ffmpeg(args):
+    # passes the args as a list, so that no shell gets to interpret the file names
+    process = subprocess.run(["ffmpeg", "-y", *args],
+                             stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    if process.returncode != 0:
+        stderr_lines = process.stderr.decode(errors="replace").strip().splitlines()
+        raise IOError(f"ffmpeg exited with {process.returncode}: {stderr_lines[-1] if stderr_lines else ''}")
+
+
+def _wait_for_ffmpeg(process):
+    # checks the exit code of an ffmpeg fed through fifos, as _run_ffmpeg does
+    returncode = process.wait()
+    if returncode != 0:
+        raise IOError(f"ffmpeg exited with {returncode}")
+
+
+def _remove_partial_output(output_path):
+    # so that a partial output is not taken for a saved p
+    if os.path.exists(output_path):
+        os.remove(output_path)
+
+
+def get_output_path(dir_path, ext, p_num, p_title):
+    if ext == "m4s":
+        return join(dir_path, f"p{p_num}_{p_title}.mp4")
+
+    return join(dir_path, f"{p_title}_p{p_num}.flv")
+
+
+def _split_ranges(ranges, range_size):
+    split_ranges = []
+    for range_start, range_end in ranges:
+        for start in range(range_start, range_end + 1, range_size):
+            split_ranges.append((start, min(start + range_size - 1, range_end)))
+
+    return split_ranges
+
+
+def _get_peak_rss():
+    # gets the peak resident set size of the process in MB
+    try:
+        import resource
+    except ImportError:
+        return None
+
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in KB elsewhere
+    return peak_rss / 1024 / 1024 if sys.platform == "darwin" else peak_rss / 1024
+
+
+class CommentCrawler:
+    """crawls the comment pages of a video into newline-delimited json, resuming interrupted crawls"""
+
+    def __init__(self, bilibili_video, output_path):
+        self.bilibili_video = bilibili_video
+        self.spider = bilibili_video.spider
+
+        self.output_path = output_path
+        self.state_path = f"{output_path}.state.json"
+
+        self.lock = threading.Lock()
+        self.done_page_nums = self._load_state()
+
+    def _load_state(self):
+        try:
+            with open(self.state_path, encoding="utf-8") as f:
+                return set(json.load(f)["done_page_nums"])
+        except (OSError, ValueError, KeyError):
+            return set()
+
+    def _save_state(self):
+        tmp_state_path = f"{self.state_path}.tmp"
+        with open(tmp_state_path, "w", encoding="utf-8") as f:
+            json.dump({"done_page_nums": sorted(self.done_page_nums)}, f)
+        os.replace(tmp_state_path, self.state_path)
+
+    @classmethod
+    def _to_row(cls, reply, page_num):
+        return {
+            "page_num": page_num,
+            "rpid": reply["rpid"],
+            "mid": reply["mid"],
+            "uname": reply["member"]["uname"],
+            "ctime": reply["ctime"],
+            "like": reply["like"],
+            "rcount": reply["rcount"],
+            "message": reply["content"]["message"],
+        }
+
+    def _crawl_page(self, output_file, page_num, comment_url):
+        if self.spider.comment_bucket:
+            self.spider.comment_bucket.acquire()
+
+        r = self.spider.http_client.get(comment_url, headers=self.bilibili_video.headers)
+        r.raise_for_status()
+        replies = r.json()["data"]["replies"] or []
+
+        # writes the page and marks it as done together, so that a resumed crawl neither skips nor repeats it
+        with self.lock:
+            for reply in replies:
+                output_file.write(json.dumps(CommentCrawler._to_row(reply, page_num), ensure_ascii=False) + "\n")
+            output_file.flush()
+
+            self.done_page_nums.add(page_num)
+            self._save_state()
+
+        return len(replies)
+
+    def crawl(self, executor):
+        """crawls the comment pages over the executor, which may be shared with the crawls of other videos"""
+        if not self.bilibili_video.total_comment_page_num:
+            print(f"{err_msg}no comments to crawl for {self.bilibili_video.bv_num}")
+            return 0
+
+        comment_pages = [(page_num, comment_url)
+                         for page_num, comment_url in enumerate(self.bilibili_video.comment_urls, start=1)
+                         if page_num not in self.done_page_nums]
+        print(f"crawling {len(comment_pages)} comment page(s) of {self.bilibili_video.bv_num} "
+              f"into {basename(self.output_path)}")
+
+        reply_num = 0
+        with open(self.output_path, "a", encoding="utf-8") as output_file:
+            futures = {executor.submit(self._crawl_page, output_file, page_num, comment_url): page_num
+                       for page_num, comment_url in comment_pages}
+            for future in futures:
+                try:
+                    reply_num += future.result()
+                except:
+                    print(f"{err_msg}cannot crawl comment page {futures[future]} of {self.bilibili_video.bv_num}")
+
+        print(f"crawled {reply_num} comment(s) of {self.bilibili_video.bv_num}")
+        return reply_num
+
+
+class DanmakuExporter:
+    """exports the danmaku of a p as xml, newline-delimited json and/or ass subtitles"""
+
+    ass_header = ("[Script Info]\nScriptType: v4.00+\nPlayResX: 1920\nPlayResY: 1080\n\n"
+                  "[V4+ Styles]\n"
+                  "Format: Name, Fontname, Fontsize, PrimaryColour, SecondaryColour, OutlineColour, BackColour, "
+                  "Bold, Italic, Underline, StrikeOut, ScaleX, ScaleY, Spacing, Angle, BorderStyle, Outline, Shadow, "
+                  "Alignment, MarginL, MarginR, MarginV, Encoding\n"
+                  "Style: Danmaku, sans-serif, 50, &H33FFFFFF, &H33FFFFFF, &H33000000, &H33000000, "
+                  "0, 0, 0, 0, 100, 100, 0, 0, 1, 2, 0, 7, 0, 0, 0, 0\n\n"
+                  "[Events]\nFormat: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text\n")
+    ass_duration = 8
+    ass_row_num = 16
+
+    format_list = ["xml", "json", "ass"]
+
+    def __init__(self, bilibili_video, p_num, dir_path, formats):
+        self.bilibili_video = bilibili_video
+        self.p_num = p_num
+        self.formats = formats
+
+        self.file_path_prefix = join(dir_path, f"p{p_num}_{bilibili_video.p_title_list[p_num - 1]}.danmaku")
+
+    @classmethod
+    def _to_row(cls, d_elem):
+        # p="time,mode,size,color,timestamp,pool,uid hash,id"
+        p_attrs = d_elem.get("p").split(",")
+        return {
+            "time": float(p_attrs[0]),
+            "mode": int(p_attrs[1]),
+            "size": int(p_attrs[2]),
+            "color": int(p_attrs[3]),
+            "timestamp": int(p_attrs[4]),
+            "uid_hash": p_attrs[6],
+            "id": p_attrs[7] if len(p_attrs) > 7 else "",
+            "text": d_elem.text or "",
+        }
+
+    @classmethod
+    def _to_ass_time(cls, seconds):
+        centiseconds = round(seconds * 100)
+        return "{}:{:02d}:{:02d}.{:02d}".format(centiseconds // 360000, centiseconds // 6000 % 60,
+                                               centiseconds // 100 % 60, centiseconds % 100)
+
+    @classmethod
+    def _to_ass_dialogue(cls, row, i):
+        # scrolls normal danmaku across one of the rows, and pins top (5) and bottom (4) ones
+        y = i % DanmakuExporter.ass_row_num * 60
+        if row["mode"] == 5:
+            position = "{\\an8\\pos(960,%d)}" % y
+        elif row["mode"] == 4:
+            position = "{\\an2\\pos(960,%d)}" % (1080 - y)
+        else:
+            position = "{\\move(1920,%d,%d,%d)}" % (y, -40 * len(row["text"]), y)
+        color = "{\\c&H%02X%02X%02X&}" % (row["color"] & 0xFF, row["color"] >> 8 & 0xFF, row["color"] >> 16 & 0xFF)
+        text = row["text"].replace("\n", " ").replace("{", "(").replace("}", ")")
+
+        return "Dialogue: 0,{},{},Danmaku,,0,0,0,,{}{}{}\n".format(
+            DanmakuExporter._to_ass_time(row["time"]),
+            DanmakuExporter._to_ass_time(row["time"] + DanmakuExporter.ass_duration),
+            position, color, text)
+
+    def export(self):
+        if all(os.path.exists(f"{self.file_path_prefix}.{fmt}") for fmt in self.formats):
+            return
+
+        files = {fmt: open(f"{self.file_path_prefix}.{fmt}.part", "w" if fmt != "xml" else "wb")
+                 for fmt in self.formats}
+        try:
+            if "ass" in files:
+                files["ass"].write(DanmakuExporter.ass_header)
+
+            # parses the decompressed xml as it streams in, writing each danmaku out right away
+            parser = ElementTree.XMLPullParser(events=("start", "end"))
+            root = None
+            i = 0
+            with self.bilibili_video.spider.http_client.stream(self.bilibili_video.get_danmaku_url(self.p_num),
+                                                               headers=self.bilibili_video.headers) as r:
+                r.raise_for_status()
+
+                for chunk in r.iter_content(chunk_size=64 * 1024):
+                    if "xml" in files:
+                        files["xml"].write(chunk)
+
+                    parser.feed(chunk)
+                    for event, elem in parser.read_events():
+                        if root is None:
+                            root = elem
+                        if event != "end" or elem.tag != "d":
+                            continue
+
+                        row = DanmakuExporter._to_row(elem)
+                        if "json" in files:
+                            files["json"].write(json.dumps(row, ensure_ascii=False) + "\n")
+                        if "ass" in files:
+                            files["ass"].write(DanmakuExporter._to_ass_dialogue(row, i))
+                        i += 1
+
+                        # frees the parsed danmaku
+                        root.clear()
+            parser.close()
+        finally:
+            for file in files.values():
+                file.close()
+
+        for fmt in self.formats:
+            os.replace(f"{self.file_path_prefix}.{fmt}.part", f"{self.file_path_prefix}.{fmt}")
+        print(f"exported {i} danmaku of p{self.p_num}")
+
+
+def _resolve_page(bilibili_video, p_num):
+    with bilibili_video.spider.metrics.time_stage("resolve"):
+        return BilibiliVideoPage(bilibili_video, p_num)
+
+
 class GetUrlThread(threading.Thread):
-    def __init__(self, thread_name, bilibili_video, p_num_queue, url_queue):
+    def __init__(self, thread_name, scheduler, p_num_queue, url_queue):
         super(GetUrlThread, self).__init__()
 
-        self.bilibili_video = bilibili_video
+        self.scheduler = scheduler
 
         self.thread_name = thread_name
         self.p_num_queue = p_num_queue
         self.url_queue = url_queue
 
     def run(self):
-        while not self.p_num_queue.empty():
-            # gets a p num
-            p_num = self.p_num_queue.get()
+        while True:
+            # gets a p num of a video
+            try:
+                video_job, p_num = self.p_num_queue.get_nowait()
+            except queue.Empty:
+                break
 
-            # puts a bilibili_video_page into the queue
-            self.url_queue.put(BilibiliVideoPage(self.bilibili_video, p_num))
+            # puts a bilibili_video_page into the queue, blocking while the downloads are resolve_ahead ps behind
+            try:
+                self.url_queue.put((video_job, _resolve_page(video_job.bilibili_video, p_num)))
+            except Exception as e:
+                print(f"{err_msg}cannot get download urls of p{p_num} of {video_job.bilibili_video.bv_num}: {e}")
+                self.scheduler.count_failed()
 
 
-class DownloadThread(threading.Thread):
-    def __init__(self, thread_name, dir_path, url_queue):
-        super(DownloadThread, self).__init__()
+class PageDownloader:
+    """downloads and saves the media of bilibili_video_page objs"""
 
+    def __init__(self, spider, dir_path, journal):
+        self.spider = spider
         self.bilibili_video_page = None
 
         self.dir_path = dir_path
+        self.journal = journal
 
-        self.thread_name = thread_name
-        self.url_queue = url_queue
+    def download(self, bilibili_video_page):
+        """downloads the media of the p, returning whether it is still to be mux()ed,
+        which is not the case when it is piped into ffmpeg or linked from the media store"""
+        if self._link_if_stored(bilibili_video_page):
+            return False
 
-    def run(self):
-        global p_num_scratched
-        while p_num_scratched < total_p_num_to_be_scratched:
-            try:
-                # gets a bilibili_video_page obj
-                self.bilibili_video_page = self.url_queue.get(True, timeout=60)
+        try:
+            self._download()
+        except:
+            self._release_media_key()
+            raise
 
-                # saves the audio and video
+        if self.spider.mux == "pipe":
+            try:
+                self.output_path = self._finish()
+            finally:
+                self._release_media_key()
+            return False
+
+        return True
+
+    def _link_if_stored(self, bilibili_video_page):
+        # checks the store before downloading, waiting for the same stream being downloaded for another video
+        self.bilibili_video_page = bilibili_video_page
+        self.output_path = None
+
+        media_store = self.spider.media_store
+        self.media_key = None
+        if media_store:
+            media_key = media_store.get_key(bilibili_video_page)
+            stored_path = media_store.acquire(media_key, bilibili_video_page.ext)
+            if stored_path:
+                self.output_path = self._link_from_store(stored_path)
+                return True
+            self.media_key = media_key
+
+            # unlinks an old output first, since ffmpeg would overwrite it in place, through to its stored link
+            old_output_path = get_output_path(self.dir_path, bilibili_video_page.ext,
+                                              bilibili_video_page.p_num, bilibili_video_page.p_title)
+            if os.path.exists(old_output_path):
+                os.remove(old_output_path)
+
+        return False
+
+    def mux(self):
+        # muxes outside of the download slot, so that ffmpeg does not keep a download waiting
+        try:
+            with self.spider.metrics.time_stage("mux"):
                 if self.bilibili_video_page.ext == "m4s":
-                    self._save_m4s(*self._get_m4s_contents())
+                    output_path = self._save_m4s(*self.m4s_paths)
                 else:
-                    self._save_flv(self._get_flv_contents())
+                    output_path = self._save_flv(self.video_paths)
 
-                try:
-                    p_num_scratched_lock.acquire()
-                    p_num_scratched += 1
-                finally:
-                    p_num_scratched_lock.release()
-            except:
-                # print("{}{} terminated due to time out "
-                #       "when getting download urls from url queue".format(err_msg, self.thread_name))
+            self.output_path = self._finish(output_path)
+        finally:
+            self._release_media_key()
+
+        return self.output_path
+
+    def _release_media_key(self):
+        if self.media_key:
+            self.spider.media_store.release(self.media_key)
+            self.media_key = None
+
+    def _link_from_store(self, stored_path):
+        output_path = get_output_path(self.dir_path, self.bilibili_video_page.ext,
+                                      self.bilibili_video_page.p_num, self.bilibili_video_page.p_title)
+
+        tmp_output_path = f"{output_path}.tmp"
+        _link_or_copy(stored_path, tmp_output_path)
+        os.replace(tmp_output_path, output_path)
+        self.journal.mark_part_done(self.bilibili_video_page.p_num, output_path, self.bilibili_video_page.cid)
+
+        print(f"p{self.bilibili_video_page.p_num}: linked from the media store")
+
+        return output_path
+
+    def _download(self):
+        self.tmp_bytes_written = 0
+
+        metrics = self.spider.metrics
+        self.part = f"{self.bilibili_video_page.bv_num}/p{self.bilibili_video_page.p_num}"
+
+        # waits for a download slot of the concurrency controller
+        concurrency_controller = self.spider.concurrency_controller
+        concurrency_controller.acquire()
+        metrics.start_part(self.part)
+        try:
+            # resolves the urls again if they expired while the p waited for a slot
+            if self.bilibili_video_page.is_stale(self.spider.url_expiry_margin):
+                with metrics.time_stage("resolve"):
+                    self.bilibili_video_page.refresh_urls()
+
+            # downloads the audio and video, muxing them at once when piped
+            if self.spider.mux == "pipe":
+                with metrics.time_stage("pipe"):
+                    if self.bilibili_video_page.ext == "m4s":
+                        self.output_path = self._pipe_m4s()
+                    else:
+                        self.output_path = self._pipe_flv()
+            elif self.bilibili_video_page.ext == "m4s":
+                with metrics.time_stage("download"):
+                    self.m4s_paths = self._download_m4s()
+            else:
+                with metrics.time_stage("download"):
+                    self.video_paths = self._download_flv()
+        except:
+            concurrency_controller.record_error()
+            raise
+        finally:
+            concurrency_controller.release()
+            metrics.finish_part(self.part)
+
+    def _finish(self, output_path=None):
+        output_path = output_path if output_path else self.output_path
+
+        # records the finished p, so that it is skipped when rerun
+        if not os.path.exists(output_path):
+            raise IOError(f"{basename(output_path)} not saved")
+        self.journal.mark_part_done(self.bilibili_video_page.p_num, output_path, self.bilibili_video_page.cid)
+
+        if self.media_key:
+            self.spider.media_store.add(self.media_key, self.bilibili_video_page.ext, output_path)
+
+        disk_bytes_written = self.tmp_bytes_written + os.path.getsize(output_path)
+        print(f"p{self.bilibili_video_page.p_num}: {disk_bytes_written / 1024 / 1024:.1f} MB written to disk")
+
+        return output_path
+
+    def _count_chunk(self, chunk):
+        self.spider.concurrency_controller.record_bytes(len(chunk))
+        self.spider.metrics.add_part_bytes(self.part, len(chunk))
+
+    def _iter_chunks(self, r, check_speed=False):
+        # measures the throughput and keeps it under the bandwidth limit
+        start_time = time.monotonic()
+        byte_num = 0
+        for chunk in r.iter_content(chunk_size=self.spider.chunk_size):
+            if self.spider.bandwidth_bucket:
+                self.spider.bandwidth_bucket.acquire(len(chunk))
+            self._count_chunk(chunk)
+
+            yield chunk
+
+            byte_num += len(chunk)
+            if check_speed:
+                self._check_speed(byte_num, start_time)
+
+    def _check_speed(self, byte_num, start_time):
+        # gives up on a slow cdn after a grace period, so that a backup url is tried
+        elapsed = time.monotonic() - start_time
+        if self.spider.min_speed and not self.spider.bandwidth_bucket \
+                and elapsed > 10 and byte_num / elapsed < self.spider.min_speed:
+            raise IOError(f"slower than {self.spider.min_speed / 1024:.0f} KB/s")
+
+    def _get_candidate_urls(self, url):
+        return [url] + self.bilibili_video_page.backup_urls.get(url, [])
+
+    def _fail_over(self, urls, i, e):
+        # raises on the last url, otherwise moves on to the next one
+        if i == len(urls) - 1:
+            raise e
+        print(f"{err_msg}{urlparse(urls[i]).netloc} failed in p{self.bilibili_video_page.p_num} ({e}), "
+              f"switching to {urlparse(urls[i + 1]).netloc}")
+
+    @contextmanager
+    def _failing_over(self, urls, i):
+        # fails over to the next url on an error in the body, which the loop over the urls then tries
+        try:
+            yield
+        except Exception as e:
+            self._fail_over(urls, i, e)
+
+    def _get_range_headers(self, start, end):
+        return {**self.bilibili_video_page.headers, "Range": f"bytes={start}-{end}"}
+
+    def _get_content_length(self, urls, i, status_code, content_range):
+        # puts the url answering the probe first,
+        # which tells the total size only if the server honours range requests
+        urls = urls[i:] + urls[:i]
+        if status_code != 206:
+            return None, urls
+
+        content_range = re.match(r"bytes 0-0/(\d+)", content_range)
+        return (int(content_range.group(1)) if content_range else None), urls
+
+    def _probe_content_length(self, urls):
+        # asks for the first byte only, so that the total size is known
+        for i, url in enumerate(urls):
+            with self._failing_over(urls, i):
+                with self.spider.http_client.stream(url, headers=self._get_range_headers(0, 0)) as r:
+                    r.raise_for_status()
+
+                return self._get_content_length(urls, i, r.status_code, r.headers.get("Content-Range", ""))
+
+    def _open_range(self, tmp_file_path, status_code, offset, end):
+        # opens the preallocated file at the offset, for the range to be written in place
+        if status_code != 206:
+            raise IOError(f"range {offset}-{end} not honoured")
+
+        f = open(tmp_file_path, "r+b")
+        f.seek(offset)
+
+        return f
+
+    def _write_range_chunk(self, f, offset, chunk):
+        f.write(chunk)
+
+        # flushes before journaling, so that journaled bytes are on disk
+        f.flush()
+        self.journal.add_range(basename(f.name), offset, offset + len(chunk) - 1)
+
+        return offset + len(chunk)
+
+    def _download_range(self, urls, tmp_file_path, start, end):
+        # resumes the range from where the failed url stopped
+        offset = start
+        for i, url in enumerate(urls):
+            with self._failing_over(urls, i):
+                with self.spider.http_client.stream(url, headers=self._get_range_headers(offset, end)) as r:
+                    r.raise_for_status()
+
+                    with self._open_range(tmp_file_path, r.status_code, offset, end) as f:
+                        for chunk in self._iter_chunks(r, check_speed=i < len(urls) - 1):
+                            offset = self._write_range_chunk(f, offset, chunk)
+
+                if offset != end + 1:
+                    raise IOError(f"range {start}-{end} incomplete")
+
+                return
+
+    def _start_ranges(self, tmp_file_path, content_length):
+        # returns the ranges still to be fetched into the tmp file, split between the connections
+        tmp_file_name = basename(tmp_file_path)
+        self.spider.metrics.add_part_total(self.part, content_length)
+
+        if os.path.exists(tmp_file_path) and os.path.getsize(tmp_file_path) == content_length:
+            # resumes the partially downloaded file
+            missing_ranges = self.journal.start_file(tmp_file_name, content_length)
+        else:
+            # preallocates the file
+            with open(tmp_file_path, "wb") as f:
+                f.truncate(content_length)
+
+            self.journal.remove_file(tmp_file_name)
+            self.journal.start_file(tmp_file_name, content_length)
+            missing_ranges = [(0, content_length - 1)]
+
+        range_size = max(math.ceil(content_length / self.spider.connection_num), self.spider.min_range_size)
+        return _split_ranges(missing_ranges, range_size)
+
+    def _check_ranges(self, tmp_file_path, content_length, file_path):
+        # verifies the size before the file is handed over for muxing
+        if os.path.getsize(tmp_file_path) != content_length \
+                or not self.journal.is_file_complete(basename(tmp_file_path)):
+            raise IOError(f"{basename(file_path)} incomplete")
+
+    def _is_file_downloaded(self, file_path):
+        # takes a stream finished in a run that stopped before muxing it
+        return os.path.exists(file_path) \
+            and self.journal.is_file_complete(f"{basename(file_path)}.part", os.path.getsize(file_path))
+
+    def _finish_file(self, tmp_file_path, file_path):
+        self.journal.finish_file(basename(tmp_file_path), os.path.getsize(tmp_file_path))
+        os.replace(tmp_file_path, file_path)
+
+    def _download_to_file(self, url, file_path):
+        if self._is_file_downloaded(file_path):
+            return
+
+        tmp_file_path = f"{file_path}.part"
+
+        content_length, urls = self._probe_content_length(self._get_candidate_urls(url))
+        if content_length:
+            # fetches the missing ranges concurrently
+            with ThreadPoolExecutor(max_workers=self.spider.connection_num) as executor:
+                futures = [executor.submit(self._download_range, urls, tmp_file_path, start, end)
+                           for start, end in self._start_ranges(tmp_file_path, content_length)]
+                for future in futures:
+                    future.result()
+
+            self._check_ranges(tmp_file_path, content_length, file_path)
+        else:
+            # streams the response into a tmp file chunk by chunk,
+            # so that at most one chunk of the media is held in memory,
+            # starting over on the next url if one fails
+            for i, url in enumerate(urls):
+                with self._failing_over(urls, i):
+                    with self.spider.http_client.stream(url, headers=self.bilibili_video_page.headers) as r:
+                        r.raise_for_status()
+
+                        with open(tmp_file_path, "wb") as f:
+                            for chunk in self._iter_chunks(r, check_speed=i < len(urls) - 1):
+                                f.write(chunk)
+                    break
+
+        self._finish_file(tmp_file_path, file_path)
+
+    def _download_to_fifo(self, url, fifo_path, process):
+        # waits for the reader to open the fifo, giving up if it exits before doing so
+        while True:
+            try:
+                fd = os.open(fifo_path, os.O_WRONLY | os.O_NONBLOCK)
                 break
+            except OSError as e:
+                if e.errno != errno.ENXIO or process.poll() is not None:
+                    raise
+                time.sleep(0.1)
+        os.set_blocking(fd, True)
+
+        # bytes in the fifo cannot be taken back, so that a backup url
+        # continues the stream from the offset reached with a range request
+        urls = self._get_candidate_urls(url)
+        offset = 0
+        with os.fdopen(fd, "wb") as f:
+            for i, url in enumerate(urls):
+                headers = self.bilibili_video_page.headers
+                if offset:
+                    headers = {**headers, "Range": f"bytes={offset}-"}
+                try:
+                    with self.spider.http_client.stream(url, headers=headers) as r:
+                        r.raise_for_status()
+
+                        if offset and r.status_code != 206:
+                            raise IOError(f"cannot resume from byte {offset}")
+
+                        for chunk in self._iter_chunks(r, check_speed=i < len(urls) - 1):
+                            f.write(chunk)
+                            offset += len(chunk)
+                    break
+                except BrokenPipeError:
+                    raise
+                except Exception as e:
+                    self._fail_over(urls, i, e)
+
+    def _get_m4s_paths(self):
+        audio_path = join(self.dir_path, "{}_p{}_audio.m4s".format(
+            self.bilibili_video_page.p_title,
+            self.bilibili_video_page.p_num))
+        video_path = join(self.dir_path, "{}_p{}_video.m4s".format(
+            self.bilibili_video_page.p_title,
+            self.bilibili_video_page.p_num))
 
-    def _get_m4s_contents(self):
+        return audio_path, video_path
+
+    def _download_m4s(self):
         print("downloading audio and video (without sound) \"{}\" in p{}".format(
             self.bilibili_video_page.p_title,
             self.bilibili_video_page.p_num))
 
+        audio_path, video_path = self._get_m4s_paths()
         try:
-            audio_content = requests.get(self.bilibili_video_page.audio_url,
-                                         headers=headers, timeout=60).content
-            video_content = requests.get(self.bilibili_video_page.video_url,
-                                         headers=headers, timeout=60).content
+            self._download_to_file(self.bilibili_video_page.audio_url, audio_path)
+            self._download_to_file(self.bilibili_video_page.video_url, video_path)
 
-            return audio_content, video_content
+            return audio_path, video_path
         except:
             print(f"{err_msg}cannot download data in p{self.bilibili_video_page.p_num}")
+            raise
 
-    def _get_flv_contents(self):
+    def _download_flv(self):
         print("downloading video \"{}\" in p{}".format(self.bilibili_video_page.p_title,
                                                        self.bilibili_video_page.p_num))
 
-        video_contents = []
-        flv_lock = threading.Lock()
-
         def get_flv_content(i, url):
-            try:
-                r = requests.get(url, headers=headers, timeout=60)
-                r.raise_for_status()
+            video_path = self._get_segment_path(i)
+            self._download_to_file(url, video_path)
 
-                flv_lock.acquire()
-            except:
-                print(f"{err_msg}cannot download data of segment {i} in p{self.bilibili_video_page.p_num}")
-            else:
-                video_contents.append((i, r.content))
-            finally:
-                flv_lock.release()
+            return video_path
 
         # gets flv video segments
-        for (i, url) in self.bilibili_video_page.video_urls:
-            threading.Thread(target=get_flv_content, args=(i, url)).start()
+        executor = ThreadPoolExecutor(max_workers=self.spider.connection_num)
+        futures = {executor.submit(get_flv_content, i, url): i
+                   for (i, url) in self.bilibili_video_page.video_urls}
 
         # waits for all segments to be downloaded
-        start = time.time()
-        while len(video_contents) != len(self.bilibili_video_page.video_urls) \
-                and time.time() - start <= 10 * 60:
-            pass
-        if len(video_contents) != len(self.bilibili_video_page.video_urls):
-            print(f"{err_msg}cannot retrieve the complete video of p{self.bilibili_video_page.p_num}")
+        done, _ = wait(futures, timeout=10 * 60)
+        executor.shutdown(wait=False, cancel_futures=True)
+
+        return self._collect_segments([(futures[future], future.exception() or future.result())
+                                       for future in done])
+
+    def _get_segment_path(self, i):
+        return join(self.dir_path, f"p{self.bilibili_video_page.p_num}_{i}.flv")
+
+    def _collect_segments(self, results):
+        # takes the (segment i, video path or the exception it failed with) of the segments finished in time,
+        # returning the (segment i, video path) of all segments in order
+        video_paths = []
+        for i, result in results:
+            if isinstance(result, BaseException):
+                print(f"{err_msg}cannot download data of segment {i} in p{self.bilibili_video_page.p_num}")
+            else:
+                video_paths.append((i, result))
+        if len(video_paths) != len(self.bilibili_video_page.video_urls):
+            raise IOError(f"cannot retrieve the complete video of p{self.bilibili_video_page.p_num}")
+
+        return sorted(video_paths, key=lambda elem: elem[0])
+
+    def _get_mp4_path(self):
+        return get_output_path(self.dir_path, "m4s", self.bilibili_video_page.p_num, self.bilibili_video_page.p_title)
+
+    def _get_flv_path(self):
+        return get_output_path(self.dir_path, "flv", self.bilibili_video_page.p_num, self.bilibili_video_page.p_title)
+
+    def _pipe_m4s(self):
+        print("downloading and combining audio and video \"{}\" in p{}".format(
+            self.bilibili_video_page.p_title,
+            self.bilibili_video_page.p_num))
+
+        mp4_file_name = self._get_mp4_path()
+        fifo_dir = tempfile.mkdtemp(dir=self.dir_path)
+        try:
+            audio_fifo, video_fifo = join(fifo_dir, "audio.m4s"), join(fifo_dir, "video.m4s")
+            os.mkfifo(audio_fifo)
+            os.mkfifo(video_fifo)
+
+            process = subprocess.Popen(["ffmpeg", "-y", "-i", video_fifo, "-i", audio_fifo, "-codec", "copy",
+                                        mp4_file_name],
+                                       stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                                       stderr=subprocess.DEVNULL)
+
+            # feeds both streams at the same time, since ffmpeg reads them interleaved
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                futures = [executor.submit(self._download_to_fifo, url, fifo, process)
+                           for url, fifo in [(self.bilibili_video_page.video_url, video_fifo),
+                                             (self.bilibili_video_page.audio_url, audio_fifo)]]
+                try:
+                    for future in futures:
+                        future.result()
+                except:
+                    process.kill()
+                    process.wait()
+                    print(f"{err_msg}cannot download data in p{self.bilibili_video_page.p_num}")
+                    raise
+            _wait_for_ffmpeg(process)
+        except:
+            _remove_partial_output(mp4_file_name)
+            raise
+        finally:
+            shutil.rmtree(fifo_dir, ignore_errors=True)
 
-        video_contents = sorted(video_contents, key=lambda elem: elem[0])
+        return mp4_file_name
 
-        return video_contents
+    def _pipe_flv(self):
+        print("downloading and concatenating video \"{}\" in p{}".format(self.bilibili_video_page.p_title,
+                                                                        self.bilibili_video_page.p_num))
+
+        video_path = self._get_flv_path()
+        fifo_dir = tempfile.mkdtemp(dir=self.dir_path)
+        try:
+            fifos = [join(fifo_dir, f"{i}.flv") for i, _ in self.bilibili_video_page.video_urls]
+            for fifo in fifos:
+                os.mkfifo(fifo)
+
+            # the concat demuxer opens the segments one after another,
+            # so that they are fed in order from a single thread
+            process = subprocess.Popen(["ffmpeg", "-y", "-f", "concat", "-safe", "0",
+                                        "-protocol_whitelist", "file,pipe", "-i", "pipe:0", "-c", "copy", video_path],
+                                       stdin=subprocess.PIPE, stdout=subprocess.DEVNULL,
+                                       stderr=subprocess.DEVNULL)
+            process.stdin.write("".join(f"file 'file:{fifo}'\n" for fifo in fifos).encode())
+            process.stdin.close()
+
+            try:
+                for (_, url), fifo in zip(self.bilibili_video_page.video_urls, fifos):
+                    self._download_to_fifo(url, fifo, process)
+            except:
+                process.kill()
+                process.wait()
+                print(f"{err_msg}cannot retrieve the complete video of p{self.bilibili_video_page.p_num}")
+                raise
+            _wait_for_ffmpeg(process)
+        except:
+            _remove_partial_output(video_path)
+            raise
+        finally:
+            shutil.rmtree(fifo_dir, ignore_errors=True)
+
+        return video_path
 
     def _combine(self, audio_path, video_path):
         # combines audio and video of the m4s file
-        mp4_file_name = join(self.dir_path, f"p{self.bilibili_video_page.p_num}_{self.bilibili_video_page.p_title}.mp4")
+        mp4_file_name = self._get_mp4_path()
         print(f"combining {basename(video_path)} and {basename(audio_path)} into {basename(mp4_file_name)}")
 
-        subprocess.call(
-            [f'ffmpeg -y -i "{video_path}" -i "{audio_path}" -codec copy "{mp4_file_name}" &> /dev/null'],
-            shell=True)
+        _run_ffmpeg(["-i", video_path, "-i", audio_path, "-codec", "copy", mp4_file_name])
 
         # removes tmp m4s files
-        os.remove(audio_path)
-        os.remove(video_path)
+        self.tmp_bytes_written += os.path.getsize(audio_path) + os.path.getsize(video_path)
+        for tmp_path in (audio_path, video_path):
+            os.remove(tmp_path)
+            self.journal.remove_file(f"{basename(tmp_path)}.part")
+
+        return mp4_file_name
 
-    def _save_m4s(self, audio_content, video_content):
+    def _save_m4s(self, audio_path, video_path):
         print("saving audio and video (without sound) \"{}\" in p{}".format(self.bilibili_video_page.p_title,
                                                                             self.bilibili_video_page.p_num))
 
-        audio_path = join(self.dir_path, "{}_p{}_audio.m4s".format(
-            self.bilibili_video_page.p_title,
-            self.bilibili_video_page.p_num))
-        video_path = join(self.dir_path, "{}_p{}_video.m4s".format(
-            self.bilibili_video_page.p_title,
-            self.bilibili_video_page.p_num))
-
-        with open(audio_path, "wb") as f_audio:
-            f_audio.write(audio_content)
-        with open(video_path, "wb") as f_video:
-            f_video.write(video_content)
-
-        self._combine(audio_path, video_path)
+        return self._combine(audio_path, video_path)
 
     def _concat(self, video_names, video_paths):
         tmp_txt_path = join(self.dir_path, f"p{self.bilibili_video_page.p_num} files.txt")
-        with open(tmp_txt_path, 'a') as f:
+        with open(tmp_txt_path, 'w') as f:
             for video_name in video_names:
+                # quotes the name the way the concat demuxer unquotes it
+                video_name = video_name.replace("'", "'\\''")
                 f.write(f"file '{video_name}'\n")
 
-        video_path = join(self.dir_path,
-                          f"{self.bilibili_video_page.p_title}_p{self.bilibili_video_page.p_num}.flv")
-        subprocess.call(
-            [f'ffmpeg -f concat -i "{tmp_txt_path}" -c copy "{video_path}" &> /dev/null'],
-            shell=True
-        )
+        video_path = self._get_flv_path()
+        _run_ffmpeg(["-f", "concat", "-safe", "0", "-i", tmp_txt_path, "-c", "copy", video_path])
 
         # removes tmp files and flv segments
         os.remove(tmp_txt_path)
-        for video_path in video_paths:
-            os.remove(video_path)
+        for tmp_video_path in video_paths:
+            self.tmp_bytes_written += os.path.getsize(tmp_video_path)
+            os.remove(tmp_video_path)
+            self.journal.remove_file(f"{basename(tmp_video_path)}.part")
+
+        return video_path
 
-    def _save_flv(self, video_contents):
+    def _save_flv(self, video_paths):
         print("saving video \"{}\" in p{}".format(self.bilibili_video_page.p_title,
                                                   self.bilibili_video_page.p_num))
 
-        video_names = [f"p{self.bilibili_video_page.p_num}_{i}.flv"
-                       for i, _ in self.bilibili_video_page.video_urls]
-        video_paths = [join(self.dir_path, video_name)
-                       for video_name in video_names]
-        for (i, content) in video_contents:
-            with open(video_paths[i - 1], "wb") as f:
-                f.write(content)
+        video_names = [basename(video_path) for _, video_path in video_paths]
+        video_paths = [video_path for _, video_path in video_paths]
+
+        return self._concat(video_names, video_paths)
+
+
+class AsyncPageDownloader(PageDownloader):
+    """downloads the media of bilibili_video_page objs on the event loop with aiohttp,
+    so that a download holds no thread, sharing the failover, range bookkeeping and muxing of PageDownloader,
+    the file writes and journal saves of which run in worker threads off the loop"""
+
+    def __init__(self, spider, dir_path, journal, session):
+        super().__init__(spider, dir_path, journal)
+
+        self.session = session
+
+    async def download_async(self, bilibili_video_page):
+        # waiting for the store may block, on a stream being downloaded for another video
+        if await asyncio.to_thread(self._link_if_stored, bilibili_video_page):
+            return False
+
+        try:
+            await self._download_async()
+        except:
+            self._release_media_key()
+            raise
+
+        return True
+
+    async def _download_async(self):
+        self.tmp_bytes_written = 0
+
+        metrics = self.spider.metrics
+        self.part = f"{self.bilibili_video_page.bv_num}/p{self.bilibili_video_page.p_num}"
+
+        # waits for a download slot of the concurrency controller
+        concurrency_controller = self.spider.concurrency_controller
+        await concurrency_controller.acquire_async()
+        metrics.start_part(self.part)
+        try:
+            # resolves the urls again if they expired while the p waited for a slot
+            if self.bilibili_video_page.is_stale(self.spider.url_expiry_margin):
+                with metrics.time_stage("resolve"):
+                    await asyncio.to_thread(self.bilibili_video_page.refresh_urls)
+
+            with metrics.time_stage("download"):
+                if self.bilibili_video_page.ext == "m4s":
+                    self.m4s_paths = await self._download_m4s_async()
+                else:
+                    self.video_paths = await self._download_flv_async()
+        except:
+            concurrency_controller.record_error()
+            raise
+        finally:
+            concurrency_controller.release()
+            metrics.finish_part(self.part)
+
+    async def _iter_chunks_async(self, r, check_speed=False):
+        # measures the throughput and keeps it under the bandwidth limit
+        start_time = time.monotonic()
+        byte_num = 0
+        async for chunk in r.content.iter_chunked(self.spider.chunk_size):
+            if self.spider.bandwidth_bucket:
+                await self.spider.bandwidth_bucket.acquire_async(len(chunk))
+            self._count_chunk(chunk)
+
+            yield chunk
+
+            byte_num += len(chunk)
+            if check_speed:
+                self._check_speed(byte_num, start_time)
+
+    async def _probe_content_length_async(self, urls):
+        # asks for the first byte only, so that the total size is known
+        for i, url in enumerate(urls):
+            with self._failing_over(urls, i):
+                async with self.spider.http_client.stream_async(self.session, url,
+                                                                headers=self._get_range_headers(0, 0)) as r:
+                    r.raise_for_status()
+
+                return self._get_content_length(urls, i, r.status, r.headers.get("Content-Range", ""))
+
+    async def _download_range_async(self, urls, tmp_file_path, start, end):
+        # resumes the range from where the failed url stopped
+        offset = start
+        for i, url in enumerate(urls):
+            with self._failing_over(urls, i):
+                async with self.spider.http_client.stream_async(self.session, url,
+                                                                headers=self._get_range_headers(offset, end)) as r:
+                    r.raise_for_status()
+
+                    # writes and journals the chunks off the loop
+                    f = await asyncio.to_thread(self._open_range, tmp_file_path, r.status, offset, end)
+                    try:
+                        async for chunk in self._iter_chunks_async(r, check_speed=i < len(urls) - 1):
+                            offset = await asyncio.to_thread(self._write_range_chunk, f, offset, chunk)
+                    finally:
+                        await asyncio.to_thread(f.close)
+
+                if offset != end + 1:
+                    raise IOError(f"range {start}-{end} incomplete")
+
+                return
+
+    async def _download_to_file_async(self, url, file_path):
+        if await asyncio.to_thread(self._is_file_downloaded, file_path):
+            return
+
+        tmp_file_path = f"{file_path}.part"
+
+        content_length, urls = await self._probe_content_length_async(self._get_candidate_urls(url))
+        if content_length:
+            # fetches the missing ranges concurrently, over at most connection_num connections
+            connection_semaphore = asyncio.Semaphore(self.spider.connection_num)
+
+            async def download_range(start, end):
+                async with connection_semaphore:
+                    await self._download_range_async(urls, tmp_file_path, start, end)
+
+            # lets every range finish before raising, as the executor of PageDownloader does
+            ranges = await asyncio.to_thread(self._start_ranges, tmp_file_path, content_length)
+            results = await asyncio.gather(*[download_range(start, end) for start, end in ranges],
+                                           return_exceptions=True)
+            for result in results:
+                if isinstance(result, BaseException):
+                    raise result
+
+            await asyncio.to_thread(self._check_ranges, tmp_file_path, content_length, file_path)
+        else:
+            # streams the response into a tmp file chunk by chunk, starting over on the next url if one fails
+            for i, url in enumerate(urls):
+                with self._failing_over(urls, i):
+                    async with self.spider.http_client.stream_async(
+                            self.session, url, headers=self.bilibili_video_page.headers) as r:
+                        r.raise_for_status()
+
+                        f = await asyncio.to_thread(open, tmp_file_path, "wb")
+                        try:
+                            async for chunk in self._iter_chunks_async(r, check_speed=i < len(urls) - 1):
+                                await asyncio.to_thread(f.write, chunk)
+                        finally:
+                            await asyncio.to_thread(f.close)
+                    break
+
+        await asyncio.to_thread(self._finish_file, tmp_file_path, file_path)
+
+    async def _download_m4s_async(self):
+        print("downloading audio and video (without sound) \"{}\" in p{}".format(
+            self.bilibili_video_page.p_title,
+            self.bilibili_video_page.p_num))
+
+        audio_path, video_path = self._get_m4s_paths()
+        try:
+            await self._download_to_file_async(self.bilibili_video_page.audio_url, audio_path)
+            await self._download_to_file_async(self.bilibili_video_page.video_url, video_path)
+
+            return audio_path, video_path
+        except:
+            print(f"{err_msg}cannot download data in p{self.bilibili_video_page.p_num}")
+            raise
+
+    async def _download_flv_async(self):
+        print("downloading video \"{}\" in p{}".format(self.bilibili_video_page.p_title,
+                                                       self.bilibili_video_page.p_num))
+
+        segment_semaphore = asyncio.Semaphore(self.spider.connection_num)
+
+        async def get_flv_content(i, url):
+            async with segment_semaphore:
+                video_path = self._get_segment_path(i)
+                await self._download_to_file_async(url, video_path)
+
+                return video_path
+
+        # gets flv video segments, giving up on them after 10 minutes
+        try:
+            results = await asyncio.wait_for(
+                asyncio.gather(*[get_flv_content(i, url) for (i, url) in self.bilibili_video_page.video_urls],
+                               return_exceptions=True),
+                timeout=10 * 60)
+        except asyncio.TimeoutError:
+            raise IOError(f"cannot retrieve the complete video of p{self.bilibili_video_page.p_num}")
+
+        return self._collect_segments([(i, result) for (i, _), result in zip(self.bilibili_video_page.video_urls,
+                                                                              results)])
+
 
-        self._concat(video_names, video_paths)
+class DownloadThread(threading.Thread):
+    def __init__(self, thread_name, scheduler, url_queue, mux_queue):
+        super(DownloadThread, self).__init__()
+
+        self.scheduler = scheduler
+
+        self.thread_name = thread_name
+        self.url_queue = url_queue
+        self.mux_queue = mux_queue
+
+    def run(self):
+        while not self.scheduler.is_done():
+            try:
+                # gets a bilibili_video_page obj
+                video_job, bilibili_video_page = self.url_queue.get(True, timeout=1)
+            except queue.Empty:
+                continue
+
+            # a failed p does not stop the thread from downloading the others
+            try:
+                page_downloader = PageDownloader(self.scheduler.spider, video_job.dir_path, video_job.journal)
+                if page_downloader.download(bilibili_video_page):
+                    # hands the p over to the mux threads, blocking while they are behind
+                    self.mux_queue.put((video_job, page_downloader))
+                else:
+                    self.scheduler.count_scratched()
+            except Exception as e:
+                print(f"{err_msg}cannot scratch p{bilibili_video_page.p_num} "
+                      f"of {video_job.bilibili_video.bv_num}: {e}")
+                self.scheduler.count_failed()
+
+
+class MuxThread(threading.Thread):
+    def __init__(self, thread_name, scheduler, mux_queue):
+        super(MuxThread, self).__init__()
 
+        self.scheduler = scheduler
 
-def create_queues(from_p_num, to_p_num):
-    # creates a queue for storing p numbers
+        self.thread_name = thread_name
+        self.mux_queue = mux_queue
+
+    def run(self):
+        while not self.scheduler.is_done():
+            try:
+                # gets a page_downloader obj whose media is downloaded
+                video_job, page_downloader = self.mux_queue.get(True, timeout=1)
+            except queue.Empty:
+                continue
+
+            try:
+                page_downloader.mux()
+                self.scheduler.count_scratched()
+            except Exception as e:
+                print(f"{err_msg}cannot mux p{page_downloader.bilibili_video_page.p_num} "
+                      f"of {video_job.bilibili_video.bv_num}: {e}")
+                self.scheduler.count_failed()
+
+
+def create_queues(tasks, url_queue_size=0, mux_queue_size=0):
+    # creates a queue for storing (video job, p number) tasks
     p_num_queue = queue.Queue()
-    # puts p numbers into the queue
-    for p_num in range(from_p_num, to_p_num + 1):
-        p_num_queue.put(p_num)
+    # puts the tasks into the queue
+    for task in tasks:
+        p_num_queue.put(task)
+
+    # creates a bounded queue for storing (video job, bilibili_video_page obj) of each p
+    url_queue = queue.Queue(maxsize=url_queue_size)
 
-    # creates a queue for storing (audio url, video url) of each video
-    url_queue = queue.Queue()
+    # creates a bounded queue for storing (video job, page_downloader obj) of each downloaded p
+    mux_queue = queue.Queue(maxsize=mux_queue_size)
 
-    return p_num_queue, url_queue
+    return p_num_queue, url_queue, mux_queue
 
 
-def create_threads(dir_path, bilibili_video, p_num_queue, url_queue):
+def create_threads(scheduler, p_num_queue, url_queue, mux_queue):
     get_url_thread_list = []
     # threads for storing bilibili_video_page objs
-    for i in range(6):
-        get_url_thread = GetUrlThread(f"get url thread {i + 1}", bilibili_video, p_num_queue, url_queue)
+    for i in range(scheduler.spider.get_url_thread_num):
+        get_url_thread = GetUrlThread(f"get url thread {i + 1}", scheduler, p_num_queue, url_queue)
         get_url_thread_list.append(get_url_thread)
 
     download_url_thread_list = []
-    # threads for downloading audio (for m4s) and video urls
-    for i in range(6):
-        download_url_thread = DownloadThread(f"download url thread {i + 1}", dir_path, url_queue)
+    # threads for downloading audio (for m4s) and video urls,
+    # as many as the concurrency controller may allow at most
+    for i in range(scheduler.spider.max_workers):
+        download_url_thread = DownloadThread(f"download url thread {i + 1}", scheduler, url_queue, mux_queue)
         download_url_thread_list.append(download_url_thread)
 
-    return get_url_thread_list, download_url_thread_list
+    mux_thread_list = []
+    # threads for muxing downloaded audio and video, each running an ffmpeg process at a time
+    for i in range(scheduler.spider.mux_thread_num):
+        mux_thread = MuxThread(f"mux thread {i + 1}", scheduler, mux_queue)
+        mux_thread_list.append(mux_thread)
 
+    return get_url_thread_list, download_url_thread_list, mux_thread_list
 
-def start_threads(get_url_thread_list, download_url_thread_list):
+
+def start_threads(get_url_thread_list, download_url_thread_list, mux_thread_list):
     for get_url_thread in get_url_thread_list:
         get_url_thread.start()
 
     for download_url_thread in download_url_thread_list:
         download_url_thread.start()
 
+    for mux_thread in mux_thread_list:
+        mux_thread.start()
+
 
-def join_threads(get_url_thread_list, download_url_thread_list):
+def join_threads(get_url_thread_list, download_url_thread_list, mux_thread_list):
     for get_url_thread in get_url_thread_list:
         get_url_thread.join()
 
     for download_url_thread in download_url_thread_list:
         download_url_thread.join()
 
+    for mux_thread in mux_thread_list:
+        mux_thread.join()
+
+
+async def _scratch_p_async(scheduler, video_job, p_num, session, resolve_ahead_semaphore, get_url_semaphore,
+                           download_semaphore, mux_semaphore):
+    # resolving and muxing run in the loop's bounded executor,
+    # resolving no more than resolve_ahead ps that are not being downloaded yet
+    await resolve_ahead_semaphore.acquire()
+    try:
+        async with get_url_semaphore:
+            bilibili_video_page = await asyncio.to_thread(_resolve_page, video_job.bilibili_video, p_num)
+
+        await download_semaphore.acquire()
+    finally:
+        resolve_ahead_semaphore.release()
+
+    # downloads on the loop with aiohttp, in the executor otherwise
+    try:
+        if session:
+            page_downloader = AsyncPageDownloader(scheduler.spider, video_job.dir_path, video_job.journal, session)
+            is_to_be_muxed = await page_downloader.download_async(bilibili_video_page)
+        else:
+            page_downloader = PageDownloader(scheduler.spider, video_job.dir_path, video_job.journal)
+            is_to_be_muxed = await asyncio.to_thread(page_downloader.download, bilibili_video_page)
+    finally:
+        download_semaphore.release()
+
+    # muxes after giving the download slot back
+    if is_to_be_muxed:
+        async with mux_semaphore:
+            await asyncio.to_thread(page_downloader.mux)
+
+
+async def run_async_engine(scheduler, tasks):
+    spider = scheduler.spider
+
+    # downloads on the loop if aiohttp is there, which piping into ffmpeg cannot, since fifos block
+    session = None
+    if spider.mux == "files":
+        try:
+            session = spider.http_client.create_async_session()
+        except ImportError:
+            print("aiohttp not installed, downloading in threads")
+
+    # bounds the num of threads instead of using one per p, starting them only when needed,
+    # which leaves the share of the downloads to waits for the media store when they run on the loop
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=spider.get_url_thread_num + spider.max_workers + spider.mux_thread_num))
+
+    # the concurrency controller narrows the downloads further
+    resolve_ahead_semaphore = asyncio.Semaphore(spider.resolve_ahead)
+    get_url_semaphore = asyncio.Semaphore(spider.get_url_thread_num)
+    download_semaphore = asyncio.Semaphore(spider.max_workers)
+    mux_semaphore = asyncio.Semaphore(spider.mux_thread_num)
+
+    try:
+        results = await asyncio.gather(*[_scratch_p_async(scheduler, video_job, p_num, session,
+                                                          resolve_ahead_semaphore, get_url_semaphore,
+                                                          download_semaphore, mux_semaphore)
+                                         for video_job, p_num in tasks],
+                                       return_exceptions=True)
+    finally:
+        if session:
+            await session.close()
+    for (video_job, p_num), result in zip(tasks, results):
+        if isinstance(result, Exception):
+            print(f"{err_msg}cannot scratch p{p_num} of {video_job.bilibili_video.bv_num}: {result}")
+            scheduler.count_failed()
+        else:
+            scheduler.count_scratched()
+
+
+class VideoJob:
+    """the ps of a video to be scratched into a dir"""
+
+    def __init__(self, bilibili_video, dir_path, journal, p_nums):
+        self.bilibili_video = bilibili_video
+        self.dir_path = dir_path
+        self.journal = journal
+        self.p_nums = p_nums
+
+
+class Scheduler:
+    """scratches the ps of many videos over one pool of resolving and downloading workers"""
+
+    def __init__(self, spider, engine="threads"):
+        self.spider = spider
+        self.engine = engine
+
+        self.video_jobs = []
+
+        self.total_p_num_to_be_scratched = 0
+        self.p_num_scratched = 0
+        self.p_num_failed = 0
+        self.p_num_scratched_lock = threading.Lock()
+
+    def add(self, video_job):
+        self.video_jobs.append(video_job)
+
+    def count_scratched(self):
+        with self.p_num_scratched_lock:
+            self.p_num_scratched += 1
+
+    def count_failed(self):
+        with self.p_num_scratched_lock:
+            self.p_num_failed += 1
+
+    def is_done(self):
+        return self.p_num_scratched + self.p_num_failed >= self.total_p_num_to_be_scratched
+
+    def _interleave(self):
+        # takes the ps of the videos in turn, so that no video waits for the others to finish
+        tasks = []
+        for round_tasks in itertools.zip_longest(*[[(video_job, p_num) for p_num in video_job.p_nums]
+                                                   for video_job in self.video_jobs]):
+            tasks.extend(task for task in round_tasks if task)
+
+        return tasks
 
-def bilibili_video_spider(bv_num, p_num, root_dir):
-    bilibili_video = BilibiliVideo(bv_num=bv_num)
+    def run(self):
+        tasks = self._interleave()
+        self.total_p_num_to_be_scratched = len(tasks)
+
+        metrics = self.spider.metrics
+        metrics.set_gauge("p_total", lambda: self.total_p_num_to_be_scratched)
+        metrics.set_gauge("p_scratched", lambda: self.p_num_scratched)
+        metrics.set_gauge("p_failed", lambda: self.p_num_failed)
+        metrics.set_gauge("active_downloads", lambda: self.spider.concurrency_controller.active)
+        metrics.set_gauge("download_limit", lambda: self.spider.concurrency_controller.limit)
+        metrics.set_stage_worker_num("resolve", self.spider.get_url_thread_num)
+        metrics.set_stage_worker_num("download", self.spider.max_workers)
+        metrics.set_stage_worker_num("pipe", self.spider.max_workers)
+        metrics.set_stage_worker_num("mux", self.spider.mux_thread_num)
+
+        if self.engine == "asyncio":
+            # resolves and downloads all ps in a single event loop
+            asyncio.run(run_async_engine(self, tasks))
+        else:
+            # creates a queue for storing p numbers,
+            # a bounded queue for bilibili_video_page objs, each of which reprs a p,
+            # and a bounded queue for downloaded ps to be muxed
+            p_num_queue, url_queue, mux_queue = create_queues(tasks, url_queue_size=self.spider.resolve_ahead,
+                                                              mux_queue_size=self.spider.mux_thread_num * 2)
+            metrics.set_gauge("p_num_queue_depth", p_num_queue.qsize)
+            metrics.set_gauge("url_queue_depth", url_queue.qsize)
+            metrics.set_gauge("mux_queue_depth", mux_queue.qsize)
+            # creates threads for retrieving bilibili_video_page objs,
+            # for downloading videos, and for muxing and saving them
+            thread_lists = create_threads(self, p_num_queue, url_queue, mux_queue)
+            # starts the threads, respectively
+            start_threads(*thread_lists)
+            # joins the threads, respectively
+            join_threads(*thread_lists)
+
+
+# permutation of the wbi keys into the key signing the query, see _sign_wbi_params
+_wbi_mixin_key_table = [46, 47, 18, 2, 53, 8, 23, 32, 15, 50, 10, 31, 58, 3, 45, 35, 27, 43, 5, 49, 33, 9, 42, 19,
+                        29, 28, 14, 39, 12, 38, 41, 13, 37, 48, 7, 16, 24, 55, 40, 61, 26, 17, 0, 1, 60, 51, 30, 4,
+                        22, 25, 54, 21, 56, 59, 6, 63, 57, 62, 11, 36, 20, 34, 44, 52]
+
+
+def _get_wbi_mixin_key(spider):
+    # the keys are the file names of the two images in the nav api, which change daily
+    r = spider.http_client.get(f"{spider.api_url}/x/web-interface/nav", headers=spider.headers)
+    r.raise_for_status()
+
+    wbi_img = r.json()["data"]["wbi_img"]
+    raw_key = "".join(os.path.splitext(basename(wbi_img[url_key]))[0] for url_key in ["img_url", "sub_url"])
+
+    return "".join(raw_key[i] for i in _wbi_mixin_key_table)[:32]
+
+
+def _sign_wbi_params(params, mixin_key):
+    # signs the sorted query, without the chars the api strips, with the mixin key
+    params = {**params, "wts": int(time.time())}
+    params = {key: "".join(char for char in str(value) if char not in "!'()*")
+              for key, value in sorted(params.items())}
+    params["w_rid"] = hashlib.md5((urlencode(params) + mixin_key).encode()).hexdigest()
+
+    return params
+
+
+def get_uploader_bv_nums(spider, mid, page_size=50):
+    """returns the bv nums of all videos of an uploader, the newest first"""
+    mixin_key = _get_wbi_mixin_key(spider)
+    headers = {**spider.headers, "Referer": f"https://space.bilibili.com/{mid}/video"}
+
+    bv_nums = []
+    page_num = 1
+    while True:
+        params = _sign_wbi_params({"mid": mid, "ps": page_size, "pn": page_num, "order": "pubdate"}, mixin_key)
+        r = spider.http_client.get(f"{spider.api_url}/x/space/wbi/arc/search?{urlencode(params)}", headers=headers)
+        r.raise_for_status()
+
+        search_dict = r.json()
+        if search_dict["code"] != 0:
+            raise ValueError(search_dict.get("message"))
+
+        vlist = search_dict["data"]["list"]["vlist"]
+        bv_nums.extend(video["bvid"] for video in vlist)
+
+        if not vlist or page_num * page_size >= search_dict["data"]["page"]["count"]:
+            break
+        page_num += 1
+
+    print(f"found {len(bv_nums)} videos of uploader {mid}")
+
+    return bv_nums
+
+
+def _sync_parts(bilibili_video, dir_path, journal):
+    """compares the ps against the manifest by cid, returning the p nums to be scratched"""
+    p_nums = []
+    moves = []
+    unchanged_num = 0
+    for p_num, cid in enumerate(bilibili_video.cid_list, start=1):
+        part = journal.get_part(p_num)
+        output_path = journal.get_output_path(p_num)
+        if output_path and part.get("cid", cid) == cid:
+            # takes parts journaled before cids were recorded as unchanged
+            if part.get("cid") is None:
+                journal.mark_part_done(p_num, output_path, cid)
+            unchanged_num += 1
+            continue
+
+        # a part moved to another p num, e.g. when a p is inserted before it, is renamed instead of re-downloaded
+        old_p_num = journal.find_part_by_cid(cid)
+        if old_p_num is not None and old_p_num != p_num:
+            moves.append((p_num, cid, journal.get_output_path(old_p_num)))
+        else:
+            p_nums.append(p_num)
+
+    # renames through tmp names, so that no part overwrites another still to be moved
+    for p_num, cid, old_output_path in moves:
+        os.replace(old_output_path, f"{old_output_path}.sync")
+    for p_num, cid, old_output_path in moves:
+        output_path = get_output_path(dir_path, bilibili_video.ext, p_num, bilibili_video.p_title_list[p_num - 1])
+        os.replace(f"{old_output_path}.sync", output_path)
+        journal.mark_part_done(p_num, output_path, cid)
 
-    # generates the headers
-    global headers
-    headers['Referer'] = bilibili_video.url
+    print(f"{bilibili_video.bv_num}: {len(p_nums)} new or changed, {len(moves)} moved, {unchanged_num} unchanged p(s)")
+
+    return p_nums
+
+
+def create_video_job(spider, bv_num, p_num, root_dir, sync=False):
+    # syncing compares against the current ps, never the cached ones
+    bilibili_video = BilibiliVideo(bv_num, spider, use_cache=not sync)
 
     # simulates logging in if the videos are flv
-    global driver
     if bilibili_video.ext == "flv":
-        log_in()
+        log_in_for_flv(spider)
 
     # Validates if the from p num and to p num are valid.
-    from_p_num, to_p_num = validate_p_num(p_num, bilibili_video.total_p_num)
-
-    global total_p_num_to_be_scratched
-    total_p_num_to_be_scratched = to_p_num - from_p_num + 1
+    if p_num is None:
+        from_p_num, to_p_num = 1, bilibili_video.total_p_num
+    else:
+        from_p_num, to_p_num = validate_p_num(p_num, bilibili_video.total_p_num)
 
     print(f"ready to scratch videos from {bilibili_video.bv_num}: {bilibili_video.video_title}")
 
@@ -552,17 +2877,358 @@ def bilibili_video_spider(bv_num, p_num, root_dir):
     dir_path = join(root_dir, bilibili_video.video_title)
     _make_dir(dir_path)
 
-    # creates a queue for storing p numbers,
-    # and a queue for bilibili_video_page objs, each of which reprs a p
-    p_num_queue, url_queue = create_queues(from_p_num, to_p_num)
-    # creates a thread for retrieving bilibili_video_page objs,
-    # and a thread for downloading and saving videos
-    get_url_thread_list, download_thread_list = create_threads(dir_path, bilibili_video, p_num_queue,
-                                                               url_queue)
-    # starts the threads, respectively
-    start_threads(get_url_thread_list, download_thread_list)
-    # joins the threads, respectively
-    join_threads(get_url_thread_list, download_thread_list)
+    journal = Journal(dir_path)
+    if sync:
+        # fetches only the new and changed ps of all ps
+        return VideoJob(bilibili_video, dir_path, journal, _sync_parts(bilibili_video, dir_path, journal))
+
+    # skips the ps finished in previous runs
+    p_nums = []
+    for p_num in range(from_p_num, to_p_num + 1):
+        if journal.is_part_done(p_num):
+            print(f"p{p_num} already scratched")
+        else:
+            p_nums.append(p_num)
+
+    return VideoJob(bilibili_video, dir_path, journal, p_nums)
+
+
+def _crawl_comments(video_jobs, executor):
+    # crawls one video after another, the pages of each over the pool shared by all videos
+    for video_job in video_jobs:
+        comment_crawler = CommentCrawler(video_job.bilibili_video, join(video_job.dir_path, "comments.jsonl"))
+        try:
+            comment_crawler.crawl(executor)
+        except Exception as e:
+            print(f"{err_msg}cannot crawl the comments of {video_job.bilibili_video.bv_num}: {e}")
+
+
+def bilibili_video_batch_spider(targets, root_dir, engine="threads", spider=None, comments=False,
+                                danmaku_formats=(), sync=False, scheduler=None):
+    """scratches (bv num, p num) targets, sharing the spider's sessions and one scheduler,
+    all ps of a target if its p num is None or when syncing"""
+    spider = spider if spider else Spider()
+    scheduler = scheduler if scheduler else Scheduler(spider, engine)
+    spider.metrics.start(spider.progress, spider.metrics_file, spider.metrics_interval)
+
+    for bv_num, p_num in targets:
+        try:
+            scheduler.add(create_video_job(spider, bv_num, p_num, root_dir, sync))
+        except Exception as e:
+            print(f"{err_msg}cannot scratch {bv_num}: {e}")
+
+    # crawls comments alongside the media
+    comment_executor = ThreadPoolExecutor(max_workers=spider.comment_thread_num)
+    comment_thread = Thread(target=_crawl_comments, args=(list(scheduler.video_jobs), comment_executor))
+    if comments:
+        comment_thread.start()
+
+    # exports danmaku alongside the media
+    danmaku_executor = ThreadPoolExecutor(max_workers=spider.danmaku_thread_num)
+    danmaku_futures = {}
+    if danmaku_formats:
+        for video_job in scheduler.video_jobs:
+            for p_num in video_job.p_nums:
+                danmaku_exporter = DanmakuExporter(video_job.bilibili_video, p_num, video_job.dir_path,
+                                                   danmaku_formats)
+                danmaku_futures[danmaku_executor.submit(danmaku_exporter.export)] = (video_job, p_num)
+
+    try:
+        scheduler.run()
+    finally:
+        spider.metrics.stop()
+
+    if comments:
+        comment_thread.join()
+    comment_executor.shutdown()
+    for danmaku_future, (video_job, p_num) in danmaku_futures.items():
+        try:
+            danmaku_future.result()
+        except:
+            print(f"{err_msg}cannot export danmaku of p{p_num} of {video_job.bilibili_video.bv_num}")
+    danmaku_executor.shutdown()
+
+    peak_rss = _get_peak_rss()
+    print(f"scratched {scheduler.p_num_scratched} of {scheduler.total_p_num_to_be_scratched} p(s)"
+          + (f", {scheduler.p_num_failed} failed" if scheduler.p_num_failed else "")
+          + (f", peak memory usage: {peak_rss:.1f} MB" if peak_rss is not None else ""))
+    spider.metrics.print_summary()
+
+    return scheduler
+
+
+def bilibili_video_spider(bv_num, p_num, root_dir, engine="threads", spider=None):
+    return bilibili_video_batch_spider([(bv_num, p_num)], root_dir, engine, spider)
+
+
+class JobQueue:
+    """jobs of the daemon, persisted to a json file so that they survive restarts"""
+
+    def __init__(self, job_file):
+        self.job_file = job_file
+
+        self.condition = threading.Condition()
+        self.jobs = {}
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.job_file, encoding="utf-8") as f:
+                self.jobs = {job["id"]: job for job in json.load(f)}
+        except (OSError, ValueError, KeyError):
+            self.jobs = {}
+
+        # requeues the jobs interrupted by the last shutdown, which resume from the journals in their dirs
+        for job in self.jobs.values():
+            if job["status"] == "running":
+                job["status"] = "queued"
+
+    def _save(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.job_file)), exist_ok=True)
+
+        tmp_job_file = f"{self.job_file}.tmp"
+        with open(tmp_job_file, "w", encoding="utf-8") as f:
+            json.dump(list(self.jobs.values()), f, ensure_ascii=False)
+        os.replace(tmp_job_file, self.job_file)
+
+    def add(self, bv_num, p_num, dir_path, priority=0, options=None):
+        with self.condition:
+            job = {"id": max(self.jobs, default=0) + 1, "bv_num": bv_num, "p_num": p_num, "dir": dir_path,
+                   "priority": priority, "options": options if options else {},
+                   "status": "queued", "created": time.time(), "started": None, "finished": None,
+                   "p_total": None, "p_scratched": 0, "p_failed": 0, "error": None}
+            self.jobs[job["id"]] = job
+            self._save()
+
+            self.condition.notify()
+            return dict(job)
+
+    def take(self):
+        """blocks until a job is queued, returning the one of the highest priority, the oldest first"""
+        with self.condition:
+            while True:
+                queued_jobs = [job for job in self.jobs.values() if job["status"] == "queued"]
+                if queued_jobs:
+                    break
+                self.condition.wait()
+
+            job = min(queued_jobs, key=lambda job: (-job["priority"], job["id"]))
+            job["status"] = "running"
+            job["started"] = time.time()
+            self._save()
+
+            return dict(job)
+
+    def update(self, job_id, **fields):
+        with self.condition:
+            self.jobs[job_id].update(fields)
+            self._save()
+
+    def get(self, job_id):
+        with self.condition:
+            job = self.jobs.get(job_id)
+            return dict(job) if job else None
+
+    def list(self, status=None):
+        with self.condition:
+            return [dict(job) for job in self.jobs.values() if not status or job["status"] == status]
+
+    def cancel(self, job_id):
+        """cancels a queued job, returning False if it is not queued"""
+        with self.condition:
+            job = self.jobs.get(job_id)
+            if not job or job["status"] != "queued":
+                return False
+
+            job["status"] = "cancelled"
+            job["finished"] = time.time()
+            self._save()
+
+            return True
+
+
+class Daemon:
+    """runs the jobs of a job queue one after another on one spider,
+    so that its sessions, cookies and caches stay warm between jobs"""
+
+    def __init__(self, spider, job_queue, engine="threads"):
+        self.spider = spider
+        # jobs may come days apart, so that the log in is checked again for each flv job
+        self.spider.recheck_login = True
+        self.job_queue = job_queue
+        self.engine = engine
+
+        # running job id -> scheduler, for live progress
+        self.schedulers = {}
+
+    def get_job(self, job_id):
+        job = self.job_queue.get(job_id)
+
+        scheduler = self.schedulers.get(job_id)
+        if job and scheduler:
+            job.update(p_total=scheduler.total_p_num_to_be_scratched or None, p_scratched=scheduler.p_num_scratched,
+                       p_failed=scheduler.p_num_failed, bytes=self.spider.metrics.byte_num)
+
+        return job
+
+    def _run_job(self, job):
+        print(f"running job {job['id']}: {job['bv_num']} p{job['p_num']} into {job['dir']}")
+
+        options = job["options"]
+        scheduler = Scheduler(self.spider, self.engine)
+        self.schedulers[job["id"]] = scheduler
+        error = None
+        try:
+            bilibili_video_batch_spider([(job["bv_num"], job["p_num"])], job["dir"], self.engine, self.spider,
+                                        comments=options.get("comments", False),
+                                        danmaku_formats=options.get("danmaku", ()),
+                                        sync=options.get("sync", False), scheduler=scheduler)
+            if not scheduler.video_jobs:
+                error = f"cannot scratch {job['bv_num']}"
+            elif scheduler.p_num_failed:
+                error = f"{scheduler.p_num_failed} p(s) failed"
+        except Exception as e:
+            error = str(e)
+        finally:
+            self.schedulers.pop(job["id"], None)
+
+        self.job_queue.update(job["id"], status="failed" if error else "done", error=error, finished=time.time(),
+                              p_total=scheduler.total_p_num_to_be_scratched,
+                              p_scratched=scheduler.p_num_scratched, p_failed=scheduler.p_num_failed)
+
+    def work(self):
+        while True:
+            self._run_job(self.job_queue.take())
+
+    def serve(self, listen):
+        server = _create_job_api_server(self, listen)
+        Thread(target=self.work, daemon=True).start()
+
+        print(f"serving the job api on {listen}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+
+
+def _create_job_api_server(daemon, listen):
+    """returns an http server of the job api, listening on HOST:PORT or unix:PATH"""
+    # http.server is only imported for the daemon
+    import socketserver
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class JobApiHandler(BaseHTTPRequestHandler):
+        """
+        POST /jobs with {"bv_num", "p_num", "dir", "priority", "sync", "comments", "danmaku"} queues a job,
+        where p_num null means all ps and jobs of a higher priority run first,
+        GET /jobs[?status=STATUS] lists the jobs, GET /jobs/ID gets the progress of a job,
+        DELETE /jobs/ID cancels a queued job, and GET /metrics gets the metrics in the prometheus text format
+        """
+
+        def log_message(self, *args):
+            pass
+
+        def _send(self, code, body, content_type="application/json"):
+            body = body.encode()
+
+            self.send_response(code)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _send_json(self, code, obj):
+            self._send(code, json.dumps(obj, ensure_ascii=False))
+
+        def _get_job_id(self, path):
+            match = re.fullmatch(r"/jobs/(\d+)", path)
+            return int(match.group(1)) if match else None
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            job_id = self._get_job_id(url.path)
+
+            if url.path == "/jobs":
+                status = parse_qs(url.query).get("status", [None])[0]
+                return self._send_json(200, daemon.job_queue.list(status))
+            if job_id is not None:
+                job = daemon.get_job(job_id)
+                return self._send_json(200, job) if job else self._send_json(404, {"error": "no such job"})
+            if url.path == "/metrics":
+                return self._send(200, Metrics.to_prometheus(daemon.spider.metrics.snapshot()),
+                                  "text/plain; version=0.0.4")
+
+            self._send_json(404, {"error": "not found"})
+
+        def do_POST(self):
+            if urlparse(self.path).path != "/jobs":
+                return self._send_json(404, {"error": "not found"})
+
+            try:
+                job_dict = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                bv_num = job_dict["bv_num"]
+                p_num = job_dict.get("p_num", "1")
+                if p_num is not None:
+                    p_num = str(p_num)
+                    parse_p_num(p_num)
+                dir_path = os.path.abspath(job_dict["dir"])
+                priority = int(job_dict.get("priority", 0))
+
+                danmaku_formats = job_dict.get("danmaku", [])
+                if not isinstance(danmaku_formats, list) \
+                        or not set(danmaku_formats) <= set(DanmakuExporter.format_list):
+                    raise ValueError(f"danmaku should be a list of {', '.join(DanmakuExporter.format_list)}")
+            except (ValueError, KeyError, TypeError) as e:
+                return self._send_json(400, {"error": f"invalid job: {e}"})
+            if not os.path.isdir(dir_path):
+                return self._send_json(400, {"error": f"{dir_path} not a dir"})
+
+            options = {option: job_dict[option] for option in ["sync", "comments", "danmaku"] if option in job_dict}
+            self._send_json(201, daemon.job_queue.add(bv_num, p_num, dir_path, priority, options))
+
+        def do_DELETE(self):
+            job_id = self._get_job_id(urlparse(self.path).path)
+            if job_id is None or not daemon.job_queue.get(job_id):
+                return self._send_json(404, {"error": "no such job"})
+            if not daemon.job_queue.cancel(job_id):
+                return self._send_json(409, {"error": "only queued jobs can be cancelled"})
+
+            self._send_json(200, daemon.job_queue.get(job_id))
+
+    if listen.startswith("unix:"):
+        class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+            daemon_threads = True
+
+        socket_path = listen[len("unix:"):]
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        return UnixHTTPServer(socket_path, JobApiHandler)
+
+    host, _, port = listen.rpartition(":")
+    return ThreadingHTTPServer((host or "127.0.0.1", int(port)), JobApiHandler)
+
+
+def read_batch_file(batch_file_path, default_p_num):
+    # reads a "BV_NUM [P_NUM]" target per line, skipping blank lines and comments
+    targets = []
+    with open(batch_file_path, encoding="utf-8") as f:
+        for line in f:
+            fields = line.split("#")[0].split()
+            if fields:
+                targets.append((fields[0], fields[1] if len(fields) > 1 else default_p_num))
+
+    return targets
+
+
+def validate_p_num_arg(input_p_num):
+    try:
+        parse_p_num(input_p_num)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+    return input_p_num
 
 
 def validate_dir(input_dir_path):
@@ -575,28 +3241,145 @@ def validate_dir(input_dir_path):
 
 
 if __name__ == '__main__':
-    driver_lock = threading.Lock()
-    p_num_scratched_lock = threading.Lock()
-
-    headers = {'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) '
-                             'Chrome/83.0.4103.61 Safari/537.36'}
-    driver = None
-
-    total_p_num_to_be_scratched = 0
-    p_num_scratched = 0
-
-    err_msg = "bilibili_video_spider.py: error: "
-
     parser = argparse.ArgumentParser(
         description="bilibili_video_spider.py - a tool for scratching videos from bilibili")
 
-    parser.add_argument("--bv-num", "-b", action="store", required=True,
-                        help="bv num of the video to be scratched")
-    parser.add_argument("--p-num", "-p", action="store", default="1",
+    parser.add_argument("--bv-num", "-b", action="append", default=[],
+                        help="bv num of the video to be scratched, can be given more than once")
+    parser.add_argument("--batch-file", action="store",
+                        help="file with a 'BV_NUM [P_NUM]' target per line")
+    parser.add_argument("--uploader", action="append", default=[],
+                        help="mid of an uploader, all of whose videos are scratched, can be given more than once")
+    parser.add_argument("--sync", action="store_true",
+                        help="scratching only the ps that are new or changed since the last run, "
+                             "comparing all ps by cid against the journal in each video dir")
+    parser.add_argument("--p-num", "-p", action="store", default="1", type=validate_p_num_arg,
                         help="p number from which videos are to be scratched")
     parser.add_argument("--dir", "-d", action="store", default=os.getcwd(), type=validate_dir,
                         help="directory for storing scratched videos")
+    parser.add_argument("--meta-cache-ttl", action="store", default=0, type=int,
+                        help="seconds for which video metadata is cached on disk (0 disables the cache)")
+    parser.add_argument("--meta-cache-dir", action="store", default=default_cache_dir,
+                        help="directory for caching video metadata")
+
+    parser.add_argument("--chunk-size", action="store", default=1024, type=int,
+                        help="size in KB of each chunk written to disk while downloading")
+
+    parser.add_argument("--connections", "-c", action="store", default=4, type=int,
+                        help="num of concurrent range requests for downloading each media file")
+
+    parser.add_argument("--per-host-connections", action="store", default=16, type=int,
+                        help="max num of concurrent requests to a single host, "
+                             "at least twice --max-workers when piping")
+    parser.add_argument("--retries", action="store", default=3, type=int,
+                        help="num of retries with backoff on 5xx responses and timeouts")
+
+    parser.add_argument("--engine", action="store", default="threads", choices=["threads", "asyncio"],
+                        help="engine for resolving and downloading ps, "
+                             "asyncio downloading on one event loop if aiohttp is installed")
+
+    parser.add_argument("--resolver", action="store", default="api", choices=["api", "page"],
+                        help="resolving download urls from the playurl api or from the page of each p")
+
+    parser.add_argument("--cookie-file", action="store",
+                        help="file for reusing the cookies of logging in")
+    parser.add_argument("--qr", action="store", default="auto", choices=["auto", "window", "terminal"],
+                        help="showing the qr code for logging in in a window or in the terminal, "
+                             "by default in a window if there is a display")
+
+    parser.add_argument("--mux", action="store", default="files", choices=["files", "pipe"],
+                        help="muxing from tmp files, which can be resumed, or from fifos fed while downloading, "
+                             "which writes each byte to disk only once")
+
+    parser.add_argument("--resolve-ahead", action="store", type=int,
+                        help="max num of ps resolved ahead of the downloads (defaults to --max-workers)")
+    parser.add_argument("--url-expiry-margin", action="store", default=300, type=int,
+                        help="seconds before their deadline at which download urls are resolved again")
+
+    parser.add_argument("--mux-threads", action="store", type=int,
+                        help="num of ffmpeg processes muxing downloaded ps at once (defaults to the num of cpus)")
+
+    parser.add_argument("--comments", action="store_true",
+                        help="crawling the comments of each video into comments.jsonl in its dir")
+    parser.add_argument("--comment-threads", action="store", default=4, type=int,
+                        help="num of threads for crawling comment pages")
+    parser.add_argument("--comment-rate", action="store", default=5, type=float,
+                        help="max num of comment pages requested per second (0 for unlimited)")
+
+    parser.add_argument("--danmaku", action="append", default=[], choices=DanmakuExporter.format_list,
+                        help="exporting the danmaku of each p in the format, can be given more than once")
+
+    parser.add_argument("--max-workers", action="store", default=16, type=int,
+                        help="max num of concurrent downloads the concurrency controller may grow to")
+    parser.add_argument("--max-bandwidth", action="store", default=0, type=int,
+                        help="max download bandwidth in KB/s (0 for unlimited)")
+    parser.add_argument("--max-request-rate", action="store", default=10, type=float,
+                        help="max num of api and page requests per second (0 for unlimited)")
+
+    parser.add_argument("--max-height", action="store", default=0, type=int,
+                        help="max height of the video stream, e.g. 720 (0 for the highest available)")
+    parser.add_argument("--codec", action="store", choices=[*dash_codec_ids, "smallest"],
+                        help="preferred codec of the video stream, or the smallest stream in the chosen resolution")
+    parser.add_argument("--max-bitrate", action="store", default=0, type=int,
+                        help="max bitrate in kbps of the video stream (0 for unlimited)")
+    parser.add_argument("--min-speed", action="store", default=64, type=int,
+                        help="speed in KB/s below which a download switches to a backup cdn url (0 never switches)")
+
+    parser.add_argument("--progress", action=argparse.BooleanOptionalAction, default=sys.stdout.isatty(),
+                        help="drawing a progress bar per p being downloaded (default on a terminal)")
+    parser.add_argument("--metrics-file", action="store",
+                        help="file for writing metrics to, in the prometheus text format if it ends with .prom, "
+                             "otherwise appending a json line per snapshot")
+    parser.add_argument("--metrics-interval", action="store", default=5, type=float,
+                        help="seconds between metrics snapshots written to the metrics file")
+
+    parser.add_argument("--media-store", action="store",
+                        help="dir of media shared by all videos, keyed by cid and quality, "
+                             "which the ps in video dirs are hardlinked to instead of downloading them again")
+
+    parser.add_argument("--www-url", action="store", default=default_www_url,
+                        help="base url of the video pages, e.g. of a mirror")
+    parser.add_argument("--api-url", action="store", default=default_api_url,
+                        help="base url of the api, e.g. of a mirror")
+
+    parser.add_argument("--daemon", action="store_true",
+                        help="running as a daemon that takes jobs from a local http api instead of exiting")
+    parser.add_argument("--listen", action="store", default="127.0.0.1:8765",
+                        help="HOST:PORT or unix:PATH the daemon serves its job api on")
+    parser.add_argument("--job-file", action="store",
+                        help="file persisting the jobs of the daemon (defaults to jobs.json in --meta-cache-dir)")
 
     args = parser.parse_args()
 
-    bilibili_video_spider(args.bv_num, args.p_num, args.dir)
+    targets = [(bv_num, args.p_num) for bv_num in args.bv_num]
+    if args.batch_file:
+        targets.extend(read_batch_file(args.batch_file, args.p_num))
+    if not targets and not args.uploader and not args.daemon:
+        parser.error("one of --bv-num, --batch-file, --uploader or --daemon is required")
+
+    spider = Spider(cache_dir=args.meta_cache_dir, meta_cache_ttl=args.meta_cache_ttl, cookie_file=args.cookie_file,
+                    chunk_size=args.chunk_size * 1024, connection_num=args.connections,
+                    resolver=args.resolver, mux=args.mux,
+                    per_host_connections=args.per_host_connections, retry_num=args.retries,
+                    comment_thread_num=args.comment_threads, comment_rate=args.comment_rate,
+                    max_workers=args.max_workers, max_bandwidth=args.max_bandwidth * 1024,
+                    request_rate=args.max_request_rate, max_height=args.max_height, codec=args.codec,
+                    max_bitrate=args.max_bitrate * 1000, min_speed=args.min_speed * 1024,
+                    progress=args.progress, metrics_file=args.metrics_file, metrics_interval=args.metrics_interval,
+                    www_url=args.www_url, api_url=args.api_url, media_store_dir=args.media_store,
+                    mux_thread_num=args.mux_threads, resolve_ahead=args.resolve_ahead,
+                    url_expiry_margin=args.url_expiry_margin, qr_mode=args.qr)
+
+    if args.daemon:
+        job_file = args.job_file if args.job_file else join(args.meta_cache_dir, "jobs.json")
+        Daemon(spider, JobQueue(job_file), args.engine).serve(args.listen)
+        sys.exit(0)
+
+    for mid in args.uploader:
+        try:
+            targets.extend((bv_num, None) for bv_num in get_uploader_bv_nums(spider, mid))
+        except Exception as e:
+            print(f"{err_msg}cannot get the videos of uploader {mid}: {e}")
+
+    bilibili_video_batch_spider(targets, args.dir, args.engine, spider, comments=args.comments,
+                                danmaku_formats=args.danmaku, sync=args.sync)